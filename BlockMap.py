@@ -0,0 +1,150 @@
+# NOTE: This script is test under Python 3.x
+
+__copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
+
+import os
+import sys
+import hashlib
+import xml.etree.ElementTree as ET
+
+# Block map sidecar compatible with bmaptool's .bmap version 2.0
+BMAP_VERSION = "2.0"
+BMAP_BLOCK = 4096
+BMAP_READ = 0x100000    # Bytes read at a time while scanning an image
+
+
+# Return the sidecar of an image, disk.img.bmap or disk.bmap, or '' if there is none
+def find_bmap(image_file_name) -> str:
+    for name in (image_file_name + ".bmap", os.path.splitext(image_file_name)[0] + ".bmap"):
+        if name != image_file_name and os.path.isfile(name):
+            return name
+    return ''
+
+
+# BmapFileChecksum covers the whole file with its own value replaced by zeros
+def _bmap_checksum(text, checksum) -> str:
+    return hashlib.sha256(text.replace(checksum, '0' * len(checksum), 1).encode()).hexdigest()
+
+
+class BlockMap:
+
+    def __init__(self, bmap_file_name):
+        self.ranges = []    # [offset, length, checksum] of every mapped range, in bytes
+        try:
+            with open(bmap_file_name, "r") as bmap_file:
+                text = bmap_file.read()
+            root = ET.fromstring(text)
+        except (IOError, OSError, ET.ParseError) as err:
+            print(f"Open {bmap_file_name} failed")
+            sys.exit(err)
+
+        try:
+            if root.tag != 'bmap' or int(root.get('version', '0').split('.')[0]) != 2:
+                raise ValueError(f"Unsupported bmap version {root.get('version')}")
+            self.image_size = int(root.findtext('ImageSize'))
+            self.block_size = int(root.findtext('BlockSize'))
+            self.checksum_type = root.findtext('ChecksumType').strip()
+            checksum = root.findtext('BmapFileChecksum').strip()
+            if _bmap_checksum(text, checksum) != checksum:
+                raise ValueError(f"{bmap_file_name} checksum mismatch")
+            for block_range in root.find('BlockMap').findall('Range'):
+                first, _, last = block_range.text.strip().partition('-')
+                offset = int(first) * self.block_size
+                end = min((int(last or first) + 1) * self.block_size, self.image_size)
+                self.ranges.append([offset, end - offset, block_range.get('chksum')])
+            hashlib.new(self.checksum_type)
+        except (AttributeError, TypeError, ValueError) as err:
+            print(f"{bmap_file_name} is not a valid block map")
+            sys.exit(err)
+
+    def mapped_size(self) -> int:
+        return sum(length for offset, length, checksum in self.ranges)
+
+    def runs(self) -> list:
+        return [(offset, length) for offset, length, checksum in self.ranges]
+
+    # Check the image is the one the map was made from, only mapped ranges are read
+    def check(self, img_data) -> bool:
+        if len(img_data) != self.image_size:
+            print(f"Image size {len(img_data)} does not match block map {self.image_size}")
+            return False
+        for offset, length, checksum in self.ranges:
+            if hashlib.new(self.checksum_type, img_data[offset: offset + length]).hexdigest() != checksum:
+                print(f"Image range 0x{offset:x} ~ 0x{offset + length:x} does not match block map")
+                return False
+        return True
+
+
+def _data_extents(image_file, size) -> list:
+    # Ask the file system where data is, images without SEEK_DATA support are all data
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            offset = os.lseek(image_file.fileno(), offset, os.SEEK_DATA)
+            end = os.lseek(image_file.fileno(), offset, os.SEEK_HOLE)
+            extents.append((offset, end))
+            offset = end
+    except OSError:
+        # ENXIO, no data after offset
+        pass
+    return extents
+
+
+# Write image_file_name + ".bmap" listing blocks that are neither holes nor all zero
+def create_bmap(image_file_name, block_size=BMAP_BLOCK) -> str:
+    ranges = []     # [first block, last block, hash]
+    block = 0
+    try:
+        with open(image_file_name, "rb") as image_file:
+            size = os.fstat(image_file.fileno()).st_size
+            for begin, end in _data_extents(image_file, size):
+                # Extents may share a block when they are not block aligned
+                block = max(block, begin // block_size)
+                image_file.seek(block * block_size)
+                while block * block_size < end:
+                    data = image_file.read(min(BMAP_READ, -(-end // block_size) * block_size - block * block_size))
+                    if len(data) == 0:
+                        break
+                    for offset in range(0, len(data), block_size):
+                        size_in_block = min(block_size, len(data) - offset)
+                        if data.count(0, offset, offset + size_in_block) != size_in_block:
+                            if len(ranges) > 0 and ranges[-1][1] == block - 1:
+                                ranges[-1][1] = block
+                            else:
+                                ranges.append([block, block, hashlib.sha256()])
+                            ranges[-1][2].update(data[offset: offset + size_in_block])
+                        block += 1
+    except (IOError, OSError) as err:
+        print(f"Open {image_file_name} failed")
+        sys.exit(err)
+
+    blocks_count = -(-size // block_size)
+    mapped = sum(last - first + 1 for first, last, checksum in ranges)
+    lines = ['<?xml version="1.0" ?>',
+             f'<bmap version="{BMAP_VERSION}">',
+             f'    <ImageSize> {size} </ImageSize>',
+             f'    <BlockSize> {block_size} </BlockSize>',
+             f'    <BlocksCount> {blocks_count} </BlocksCount>',
+             f'    <MappedBlocksCount> {mapped} </MappedBlocksCount>',
+             '    <ChecksumType> sha256 </ChecksumType>',
+             f'    <BmapFileChecksum> {"0" * 64} </BmapFileChecksum>',
+             '    <BlockMap>']
+    for first, last, checksum in ranges:
+        text = f"{first}-{last}" if last != first else f"{first}"
+        lines.append(f'        <Range chksum="{checksum.hexdigest()}"> {text} </Range>')
+    lines += ['    </BlockMap>', '</bmap>', '']
+    text = '\n'.join(lines)
+    text = text.replace('0' * 64, hashlib.sha256(text.encode()).hexdigest(), 1)
+
+    bmap_file_name = image_file_name + ".bmap"
+    try:
+        with open(bmap_file_name, "w") as bmap_file:
+            bmap_file.write(text)
+    except (IOError, OSError) as err:
+        print(f"Create {bmap_file_name} failed")
+        sys.exit(err)
+    print(f"{mapped} of {blocks_count} blocks mapped, {bmap_file_name} created")
+    return bmap_file_name
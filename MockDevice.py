@@ -0,0 +1,237 @@
+# NOTE: This script is test under Python 3.x
+
+__copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
+
+# Emulated MA35 devices standing in for USB hardware, selected with NUWRITER_MOCK=<device count>.
+# A device starts in the boot ROM, takes the DDR ini and xusb.bin of an attach, then re-enumerates
+# at a new address running xusb. xusb keeps each media in memory and handles info, write, read and erase.
+# Device state lasts as long as the process, so run a sequence of commands through --daemon.
+# plug() and unplug() swap boards like an operator at a --station.
+
+import os
+import time
+import threading
+from struct import pack, unpack
+import usb.core
+
+ACK = 0x55AA55AA
+XFER_LEN_CMD = 0x0012
+GET_INFO_CMD = 0x0005
+ACT_WRITE = 2
+ACT_ERASE = 3
+ACT_READ = 4
+READ_CHUNK = 4096
+PAGE = 0x10000      # Media are kept in pages of this size, pages never written read back as 0xFF
+# Bytes per second a device takes on its bulk OUT pipe, NUWRITER_MOCK_RATE. 0 is as fast as the host goes.
+RATE = float(os.environ.get("NUWRITER_MOCK_RATE", "0"))
+# Seconds xusb stays busy after a write, NAKing the next command like SPI NAND still programming, NUWRITER_MOCK_BUSY
+BUSY = float(os.environ.get("NUWRITER_MOCK_BUSY", "0"))
+
+# Geometry reported by get_info, 128 MB NAND and SPI NAND, 128 MB eMMC
+INFO = pack('<IIIIIIIIBBBBIIIIIHHBBBBIIIBBBBI',
+            64, 2048, 1024, 0, 64, 0, 0xEF4018, 0, 0x6B, 0x05, 0x01, 0, 8, 0x40000, 0,
+            0, 0xEFAA21, 2048, 64, 0x6B, 0x0F, 0x1F, 0, 8, 1024, 64, 9, 15, 0, 1, 0)
+
+_lock = threading.RLock()
+_devices = None
+_next_address = 1
+
+
+def _address() -> int:
+    global _next_address
+    # Boards re-enumerate from their own threads
+    with _lock:
+        _next_address += 1
+        return _next_address
+
+
+class _Context:
+    # What usb.util.dispose_resources() calls, nothing to release
+
+    def dispose(self, device, close_handle=True) -> None:
+        pass
+
+
+class MockDevice:
+
+    def __init__(self, index):
+        self.bus = 1
+        self.address = _address()
+        self.port_numbers = (index + 1,)
+        self._ctx = _Context()
+        self.xusb = False
+        self.info = INFO    # Replace to emulate a station with mixed flash parts
+        self.rate = RATE
+        self.busy = BUSY
+        self.busy_until = 0.0
+        self.media = 0
+        self.storage = {}   # {media: {page number: bytearray}}
+        self.out = bytearray()
+        self.state = 'header'
+        self.stage = 0      # ROM: 0 waits for the DDR ini, 1 for xusb.bin
+        self.remain = 0
+
+    @property
+    def device(self):
+        # find(find_all=False) results are read through .device
+        return self
+
+    def set_configuration(self) -> None:
+        pass
+
+    def ctrl_transfer(self, bm_request_type, b_request, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        if b_request == 0xA0 and wValue == XFER_LEN_CMD:
+            return 0
+        if self.xusb is False:
+            raise usb.core.USBError("Pipe error")
+        if b_request == 0xB0 and wValue == GET_INFO_CMD:
+            self.state = 'info'
+        elif b_request == 0xB0:
+            self.media = wValue
+        return 0
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        data = bytes(data)
+        if self.xusb is True and self.state == 'cmd' and time.monotonic() < self.busy_until:
+            # NAKed until the timeout of the transfer or the end of the busy time
+            time.sleep(min(self.busy_until - time.monotonic(), (timeout or 1000) / 1000))
+            if time.monotonic() < self.busy_until:
+                raise usb.core.USBTimeoutError("Operation timed out")
+        if self.rate > 0:
+            time.sleep(len(data) / self.rate)    # Each device has its own link, waits overlap like real transfers
+        if self.xusb is False:
+            self.__rom(data)
+        elif self.state == 'info':
+            self.out += self.info + pack('<I', ACK)
+            self.state = 'cmd'
+        elif self.state == 'cmd':
+            self.__command(data)
+        elif self.state == 'write':
+            if self.act == ACT_WRITE:
+                self.__store(self.offset, data)
+            self.offset += len(data)
+            self.remain -= len(data)
+            self.out += pack('<I', len(data))
+            if self.remain <= 0:
+                self.out += pack('<I', ACK)
+                self.state = 'cmd'
+                self.busy_until = time.monotonic() + self.busy
+        elif self.state == 'read':
+            self.remain -= unpack('<I', data[0:4])[0]
+            if self.remain > 0:
+                self.__send_read()
+            else:
+                self.state = 'cmd'
+        return len(data)
+
+    def read(self, endpoint, size, timeout=None):
+        if len(self.out) == 0:
+            raise usb.core.USBTimeoutError("Operation timed out")
+        data = bytes(self.out[0: size])
+        del self.out[0: size]
+        return data
+
+    def __rom(self, data) -> None:
+        if self.state == 'header':
+            self.remain = unpack('<I', data[0:4])[0]
+            self.state = 'load'
+            return
+        self.remain -= len(data)
+        if self.stage == 0:
+            # DDR ini arrives in one transfer, acked with its length then ACK
+            if self.remain <= 0:
+                self.out += pack('<I', len(data)) + pack('<I', ACK)
+                self.stage = 1
+                self.state = 'header'
+            return
+        self.out += pack('<I', len(data))
+        if self.remain <= 0:
+            # Jump to xusb, which comes back as a new device on the same port
+            self.xusb = True
+            self.address = _address()
+            self.out = bytearray()
+            self.state = 'cmd'
+
+    def __command(self, data) -> None:
+        start, length, self.act, option = unpack('<QQII', data[0:24])
+        self.out += pack('<I', ACK)
+        if self.act == ACT_READ:
+            self.offset = start
+            self.remain = length
+            self.state = 'read'
+            self.__send_read()
+        elif self.act == ACT_ERASE:
+            self.__erase(start, length)
+            self.out += pack('<I', 100)
+        elif self.act in (0, 1, ACT_WRITE) and length > 0:
+            # Write data, or an image loaded to run
+            self.offset = start
+            self.remain = length
+            self.state = 'write'
+        elif self.act == ACT_WRITE:
+            self.out += pack('<I', ACK)
+
+    def __store(self, offset, data) -> None:
+        pages = self.storage.setdefault(self.media, {})
+        done = 0
+        while done < len(data):
+            page, begin = divmod(offset + done, PAGE)
+            size = min(PAGE - begin, len(data) - done)
+            pages.setdefault(page, bytearray(b'\xFF' * PAGE))[begin: begin + size] = data[done: done + size]
+            done += size
+
+    def __load(self, offset, size) -> bytes:
+        pages = self.storage.get(self.media, {})
+        data = bytearray()
+        while len(data) < size:
+            page, begin = divmod(offset + len(data), PAGE)
+            length = min(PAGE - begin, size - len(data))
+            data += pages[page][begin: begin + length] if page in pages else b'\xFF' * length
+        return bytes(data)
+
+    def __erase(self, start, length) -> None:
+        pages = self.storage.setdefault(self.media, {})
+        if length == 0:
+            pages.clear()
+            return
+        for page in range(start // PAGE, -(-(start + length) // PAGE)):
+            if page in pages:
+                begin = max(start - page * PAGE, 0)
+                end = min(start + length - page * PAGE, PAGE)
+                pages[page][begin: end] = b'\xFF' * (end - begin)
+
+    def __send_read(self) -> None:
+        size = min(READ_CHUNK, self.remain)
+        self.out += pack('<I', size) + self.__load(self.offset, size)
+        self.offset += size
+
+
+# Replace the emulated devices with count new ones in the boot ROM
+def reset(count) -> None:
+    global _devices
+    with _lock:
+        _devices = [MockDevice(i) for i in range(count)]
+
+
+# Plug a new board in the boot ROM into a port, replacing the one there
+def plug(index) -> MockDevice:
+    global _devices
+    board = MockDevice(index)
+    with _lock:
+        _devices = [dev for dev in _devices or [] if dev.port_numbers != board.port_numbers] + [board]
+    return board
+
+
+def unplug(index) -> None:
+    global _devices
+    with _lock:
+        _devices = [dev for dev in _devices or [] if dev.port_numbers != (index + 1,)]
+
+
+# usb.core.find() over the emulated devices
+def find(find_all=False, **kwargs):
+    if _devices is None:
+        reset(int(os.environ.get("NUWRITER_MOCK", "1"), 0))
+    if find_all is True:
+        return iter(_devices)
+    return [_devices[0]] if len(_devices) > 0 else None
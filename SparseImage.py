@@ -0,0 +1,126 @@
+# NOTE: This script is test under Python 3.x
+
+__copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
+
+import sys
+import mmap
+import bisect
+from struct import unpack
+
+# Android sparse image (simg) format
+SPARSE_MAGIC = 0xED26FF3A
+SPARSE_HEADER_LEN = 28
+CHUNK_HEADER_LEN = 12
+CHUNK_RAW = 0xCAC1
+CHUNK_FILL = 0xCAC2
+CHUNK_DONT_CARE = 0xCAC3
+CHUNK_CRC32 = 0xCAC4
+
+
+def is_sparse(file_name) -> bool:
+    try:
+        with open(file_name, "rb") as image_file:
+            magic = image_file.read(4)
+    except (IOError, OSError):
+        return False
+    return len(magic) == 4 and int.from_bytes(magic, byteorder='little') == SPARSE_MAGIC
+
+
+class SparseImage:
+
+    # DONT_CARE ranges read as gap bytes when the whole image is sliced, 0xFF leaves NAND blocks erased
+    def __init__(self, file_name, gap=0):
+        # [output offset, length, offset of RAW data in file or -1, FILL pattern]
+        self.chunk_list = []
+        self.gap = gap
+        try:
+            with open(file_name, "rb") as image_file:
+                self.data = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as err:
+            print(f"Open {file_name} failed")
+            sys.exit(err)
+        self.view = memoryview(self.data)
+
+        if len(self.data) < SPARSE_HEADER_LEN:
+            print(f"{file_name} is not a sparse image")
+            sys.exit(0)
+        magic, major, minor, file_hdr_len, chunk_hdr_len, block_size, block_cnt, chunk_cnt, checksum = \
+            unpack('<IHHHHIIII', self.data[0: SPARSE_HEADER_LEN])
+        if magic != SPARSE_MAGIC or major != 1 or file_hdr_len < SPARSE_HEADER_LEN or \
+           chunk_hdr_len < CHUNK_HEADER_LEN or block_size % 4 != 0:
+            print(f"{file_name} is not a supported sparse image")
+            sys.exit(0)
+        self.size = block_cnt * block_size
+
+        # Walk the chunk headers, data is left in the file until it is sent
+        index = file_hdr_len
+        offset = 0
+        for _ in range(chunk_cnt):
+            if index + chunk_hdr_len > len(self.data):
+                print(f"{file_name} is truncated")
+                sys.exit(0)
+            chunk_type, reserved, chunk_blocks, chunk_len = unpack('<HHII', self.data[index: index + CHUNK_HEADER_LEN])
+            length = chunk_blocks * block_size
+            body = index + chunk_hdr_len
+            if index + chunk_len > len(self.data):
+                print(f"{file_name} is truncated")
+                sys.exit(0)
+            if chunk_type == CHUNK_RAW:
+                if chunk_len != chunk_hdr_len + length:
+                    print(f"{file_name} RAW chunk @ 0x{index:x} size error")
+                    sys.exit(0)
+                if length > 0:
+                    self.chunk_list.append([offset, length, body, b''])
+            elif chunk_type == CHUNK_FILL:
+                if length > 0:
+                    self.chunk_list.append([offset, length, -1, bytes(self.data[body: body + 4])])
+            elif chunk_type not in (CHUNK_DONT_CARE, CHUNK_CRC32):
+                print(f"{file_name} unknown chunk type 0x{chunk_type:x} @ 0x{index:x}")
+                sys.exit(0)
+            # DONT_CARE leaves a gap, CRC32 carries nothing to write
+            offset += length
+            index += chunk_len
+        if offset != self.size:
+            print(f"{file_name} chunks cover {offset} bytes, expect {self.size}")
+            sys.exit(0)
+        self.chunk_start = [chunk[0] for chunk in self.chunk_list]
+
+    def __len__(self) -> int:
+        return self.size
+
+    # (offset, length) of every range to write, runs are broken by DONT_CARE chunks
+    def runs(self) -> list:
+        runs = []
+        for offset, length, file_offset, fill in self.chunk_list:
+            if len(runs) > 0 and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+        return runs
+
+    def __pieces(self, start, end):
+        # RAW data as views of the file, FILL generated for just this range, DONT_CARE as gap bytes
+        i = bisect.bisect_right(self.chunk_start, start) - 1
+        while start < end:
+            if i >= 0 and start < self.chunk_list[i][0] + self.chunk_list[i][1]:
+                offset, length, file_offset, fill = self.chunk_list[i]
+                size = min(end, offset + length) - start
+                if file_offset >= 0:
+                    yield self.view[file_offset + start - offset: file_offset + start - offset + size]
+                else:
+                    shift = (start - offset) % 4
+                    yield (fill * ((shift + size) // 4 + 1))[shift: shift + size]
+            else:
+                size = min(end, self.chunk_start[i + 1] if i + 1 < len(self.chunk_list) else end) - start
+                yield bytes([self.gap]) * size
+            start += size
+            if i + 1 < len(self.chunk_list) and start >= self.chunk_start[i + 1]:
+                i += 1
+
+    # Slice the expanded image like a memoryview of the raw file, only one slice is expanded at a time
+    def __getitem__(self, index) -> memoryview:
+        start, end, step = index.indices(self.size)
+        pieces = list(self.__pieces(start, end))
+        if len(pieces) == 1:
+            return memoryview(pieces[0])
+        return memoryview(b''.join(pieces))
@@ -0,0 +1,172 @@
+# NOTE: This script is test under Python 3.x
+
+__copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
+
+import io
+import sys
+import gzip
+import lzma
+import zlib
+import queue
+import threading
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STREAM_SEGMENT = 0x200000   # Decompressed bytes per segment handed to the USB writer
+STREAM_DEPTH = 2            # Segments decompressed ahead of the USB writer
+
+COMPRESS_NONE = 0xFFFFFFFF  # Same as the reserved field of a pack image descriptor
+COMPRESS_GZIP = 1
+COMPRESS_XZ = 2
+COMPRESS_ZSTD = 3
+COMPRESS_ZLIB = 4           # Pack v2 only, a zlib stream has no reliable magic to detect it by
+
+DECOMPRESS_ERRORS = (IOError, OSError, EOFError, lzma.LZMAError, zlib.error)
+if zstandard is not None:
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+
+def compress_type(head) -> int:
+    head = bytes(head[0:6])
+    if head[0:2] == b'\x1f\x8b':
+        return COMPRESS_GZIP
+    if head[0:6] == b'\xfd7zXZ\x00':
+        return COMPRESS_XZ
+    if head[0:4] == b'\x28\xb5\x2f\xfd':
+        return COMPRESS_ZSTD
+    return COMPRESS_NONE
+
+
+def file_compress_type(file_name) -> int:
+    try:
+        with open(file_name, "rb") as image_file:
+            return compress_type(image_file.read(6))
+    except (IOError, OSError) as err:
+        print(f"Open {file_name} failed")
+        sys.exit(err)
+
+
+# Compression object for pack v2 images, compress() then flush()
+def compressor(compress):
+    if compress == COMPRESS_ZLIB:
+        return zlib.compressobj(9)
+    if compress == COMPRESS_ZSTD:
+        if zstandard is None:
+            print("Please install the zstandard module to pack zstd images")
+            sys.exit(0)
+        return zstandard.ZstdCompressor(level=19).compressobj()
+    print(f"Unsupported compression {compress}")
+    sys.exit(0)
+
+
+class _ViewReader(io.RawIOBase):
+    # Compressed data in a pack is read through its view without copying it out first
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf) -> int:
+        size = min(len(buf), len(self.view) - self.pos)
+        buf[0: size] = self.view[self.pos: self.pos + size]
+        self.pos += size
+        return size
+
+
+class _ZlibReader:
+
+    def __init__(self, source):
+        self.source = source
+        self.decompressor = zlib.decompressobj()
+
+    def read(self, size) -> bytes:
+        data = b''
+        while len(data) == 0 and not self.decompressor.eof:
+            compressed = self.decompressor.unconsumed_tail or self.source.read(STREAM_SEGMENT)
+            if len(compressed) == 0:
+                raise EOFError("Compressed data ended before the end of the zlib stream")
+            data = self.decompressor.decompress(compressed, size)
+        return data
+
+
+class StreamImage:
+    # Decompress a file name or memoryview in a thread running ahead of its one consumer
+
+    # compress is detected from the data unless given.
+    def __init__(self, source, segment_size=STREAM_SEGMENT, compress=None):
+        self.segment_size = segment_size
+        self.error = None
+        self.segments = queue.Queue(STREAM_DEPTH)
+        self.stop = threading.Event()
+        if isinstance(source, str):
+            try:
+                self.source = open(source, "rb")
+            except (IOError, OSError) as err:
+                print(f"Open {source} failed")
+                sys.exit(err)
+        else:
+            self.source = io.BufferedReader(_ViewReader(source))
+        self.compress = compress_type(self.source.peek(6)) if compress is None else compress
+        if self.compress == COMPRESS_NONE:
+            print("Not a gzip, xz or zstd image")
+            sys.exit(0)
+        if self.compress == COMPRESS_ZSTD and zstandard is None:
+            print("Please install the zstandard module to program .zst images")
+            sys.exit(0)
+        self.thread = threading.Thread(target=self.__thread, daemon=True)
+        self.thread.start()
+
+    def __reader(self):
+        if self.compress == COMPRESS_GZIP:
+            return gzip.GzipFile(fileobj=self.source, mode="rb")
+        if self.compress == COMPRESS_XZ:
+            return lzma.LZMAFile(self.source)
+        if self.compress == COMPRESS_ZLIB:
+            return _ZlibReader(self.source)
+        return zstandard.ZstdDecompressor().stream_reader(self.source, read_across_frames=True)
+
+    def __put(self, item) -> bool:
+        # Wait for room in the queue unless the consumer has gone
+        while not self.stop.is_set():
+            try:
+                self.segments.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __thread(self):
+        offset = 0
+        try:
+            reader = self.__reader()
+            while True:
+                segment = bytearray()
+                while len(segment) < self.segment_size:
+                    data = reader.read(self.segment_size - len(segment))
+                    if len(data) == 0:
+                        break
+                    segment += data
+                if len(segment) == 0 or not self.__put((offset, memoryview(segment))):
+                    break
+                offset += len(segment)
+        except DECOMPRESS_ERRORS as err:
+            self.error = err
+        finally:
+            self.__put(None)
+            self.source.close()
+
+    # Yield (offset, data) of each decompressed segment, check error once it ends
+    def __iter__(self):
+        while True:
+            item = self.segments.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self) -> None:
+        self.stop.set()
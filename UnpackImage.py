@@ -2,46 +2,176 @@
 
 __copyright__ = "Copyright (C) 2020 Nuvoton Technology Corp. All rights reserved"
 
+import os
 import sys
-import crcmod
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from crc32 import crc32, Crc32
+
+CRC_BLOCK = 0x400000    # Bytes fed to the background CRC per update
+
+PACK_MARKER = b'\x20\x54\x56\x4e'
+# Pack v2: marker, CRC32 of count ~ end of TOC, image count, CRC chunk size, then one TOC entry per image.
+# TOC entry: length(8) offset(8) type(4) compress(4) data offset(8) stored length(8) CRC table offset(8)
+#            CRC table CRC32(4) sparse group(4) SHA-256 of the programmed content(32)
+# Runs of one sparse image share a sparse group, the index of their first entry, 0xFFFFFFFF for other images.
+# Data is stored at 16 byte boundaries, each followed by its table of CRC32 per CRC chunk of stored data.
+PACK_V2_MARKER = b'\x32\x54\x56\x4e'
+PACK_V2_ENTRY = 88
+COMPRESS_NONE = 0xFFFFFFFF
+NO_GROUP = 0xFFFFFFFF
 
 
 class UnpackImage:
 
-    def __init__(self, pack_file_name, nocrc):
+    def __init__(self, pack_file_name, nocrc, background=False):
         self.img_list = []
+        self.crc_done = threading.Event()
+        self.crc_ok = True
+        # Map the pack instead of reading it, only the pages actually sent get loaded
         try:
             with open(pack_file_name, "rb") as pack_file:
-                self.pack_data = pack_file.read()
-        except (IOError, OSError) as err:
+                self.pack_data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as err:
             print(f"Open {pack_file_name} failed")
             sys.exit(err)
 
-        if self.pack_data[0:4] != b'\x20\x54\x56\x4e':
+        self.version = {PACK_MARKER: 1, PACK_V2_MARKER: 2}.get(self.pack_data[0:4], 0)
+        if self.version == 0:
             print(f"{pack_file_name} marker check failed")
             sys.exit(0)
+        # img_content() hands out slices of this view instead of copies
+        self.pack_view = memoryview(self.pack_data)
 
         print("Waiting for unpack Images ...")
-        if nocrc == 0:
-            print("check pack file crc32 ...")
-            crc32_func = crcmod.predefined.mkCrcFun('crc-32')
-            checksum = crc32_func(self.pack_data[8:])
-            if checksum != int.from_bytes(self.pack_data[4:8], byteorder='little'):
-                print(f"{pack_file_name} CRC check failed")
-                sys.exit(0)
         self.image_cnt = int.from_bytes(self.pack_data[8:12], byteorder='little')
-        # 1st image descriptor begins @ 0x10
+        if self.version == 2:
+            self.__parse_toc(pack_file_name, nocrc)
+        else:
+            self.__parse_descriptors(pack_file_name)
+        self.img_done = [threading.Event() for _ in range(self.image_cnt)]
+        self.img_ok = [True] * self.image_cnt
+
+        if nocrc == 0 and background is True:
+            # Images can be sent while the CRC runs, crc_check() gives the verdict
+            print("check pack file crc32 in background ...")
+            threading.Thread(target=self.__crc_thread, args=(pack_file_name,), daemon=True).start()
+        else:
+            if nocrc == 0 and self.version == 2:
+                print("check pack file chunk crc32 ...")
+                self.__check_chunks(pack_file_name)
+                if self.crc_ok is False:
+                    sys.exit(0)
+            elif nocrc == 0:
+                print("check pack file crc32 ...")
+                checksum = crc32(self.pack_view[8:])
+                if checksum != int.from_bytes(self.pack_data[4:8], byteorder='little'):
+                    print(f"{pack_file_name} CRC check failed")
+                    sys.exit(0)
+            for done in self.img_done:
+                done.set()
+            self.crc_done.set()
+
+    def __parse_descriptors(self, pack_file_name):
+        # 1st image descriptor begins @ 0x10. Walking the descriptors only touches their pages.
         index = 0x10
         for _ in range(self.image_cnt):
-            # Put the image length, offset ,attribute in list
-            self.img_list.append([int.from_bytes(self.pack_data[index: index + 8], byteorder='little'),
+            if index + 24 > len(self.pack_data):
+                print(f"{pack_file_name} is truncated")
+                sys.exit(0)
+            # Image length, offset, attribute, data offset, stored as is, stored length, no CRC table or hash
+            length = int.from_bytes(self.pack_data[index: index + 8], byteorder='little')
+            self.img_list.append([length,
                                   int.from_bytes(self.pack_data[index + 8: index + 16], byteorder='little'),
                                   int.from_bytes(self.pack_data[index + 16: index + 20], byteorder='little'),
-                                  index + 24])
-            index += int.from_bytes(self.pack_data[index: index + 8], byteorder='little') + 24  # 24 is image header
+                                  index + 24,
+                                  COMPRESS_NONE,
+                                  length, 0, 0, None, NO_GROUP])
+            index += length + 24  # 24 is image header
             if index % 16 != 0:
                 index += 16 - (index & 0xF)   # round to 16-byte align
 
+    def __parse_toc(self, pack_file_name, nocrc):
+        # The TOC gives every image directly, no need to walk the data
+        self.chunk_size = int.from_bytes(self.pack_data[12:16], byteorder='little')
+        toc_end = 16 + self.image_cnt * PACK_V2_ENTRY
+        if toc_end > len(self.pack_data) or self.chunk_size == 0:
+            print(f"{pack_file_name} is truncated")
+            sys.exit(0)
+        if nocrc == 0 and crc32(self.pack_view[8: toc_end]) != int.from_bytes(self.pack_data[4:8], byteorder='little'):
+            print(f"{pack_file_name} TOC CRC check failed")
+            sys.exit(0)
+        for index in range(16, toc_end, PACK_V2_ENTRY):
+            entry = [int.from_bytes(self.pack_data[index + begin: index + end], byteorder='little')
+                     for begin, end in ((0, 8), (8, 16), (16, 20), (24, 32), (20, 24), (32, 40), (40, 48), (48, 52))]
+            entry.append(bytes(self.pack_data[index + 56: index + 88]))
+            entry.append(int.from_bytes(self.pack_data[index + 52: index + 56], byteorder='little'))
+            if entry[3] + entry[5] > len(self.pack_data) or entry[6] + self.__table_len(entry) > len(self.pack_data):
+                print(f"{pack_file_name} is truncated")
+                sys.exit(0)
+            self.img_list.append(entry)
+
+    def __table_len(self, entry):
+        return (entry[5] + self.chunk_size - 1) // self.chunk_size * 4
+
+    def __img_chunk_crc(self, index) -> bool:
+        # Check the CRC table itself, then each chunk of stored data against it
+        entry = self.img_list[index]
+        table = self.pack_view[entry[6]: entry[6] + self.__table_len(entry)]
+        if crc32(table) != entry[7]:
+            return False
+        for chunk, offset in enumerate(range(0, entry[5], self.chunk_size)):
+            data = self.pack_view[entry[3] + offset: entry[3] + min(offset + self.chunk_size, entry[5])]
+            if crc32(data) != int.from_bytes(table[chunk * 4: chunk * 4 + 4], byteorder='little'):
+                return False
+        return True
+
+    def __check_chunks(self, pack_file_name):
+        # Images are independent, check them in parallel. zlib releases the GIL while it runs.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            self.img_ok = list(executor.map(self.__img_chunk_crc, range(self.image_cnt)))
+        for index in range(self.image_cnt):
+            if self.img_ok[index] is False:
+                print(f"{pack_file_name} image {index} CRC check failed")
+                self.crc_ok = False
+
+    def __crc_thread(self, pack_file_name):
+        if self.version == 2:
+            # Check in programming order and release each image as soon as it is done
+            for index in range(self.image_cnt):
+                self.img_ok[index] = self.__img_chunk_crc(index)
+                if self.img_ok[index] is False:
+                    print(f"{pack_file_name} image {index} CRC check failed")
+                    self.crc_ok = False
+                self.img_done[index].set()
+            self.crc_done.set()
+            return
+        checksum = Crc32()
+        for offset in range(8, len(self.pack_data), CRC_BLOCK):
+            checksum.update(self.pack_view[offset: offset + CRC_BLOCK])
+        self.crc_ok = checksum.get() == int.from_bytes(self.pack_data[4:8], byteorder='little')
+        if self.crc_ok is False:
+            print(f"{pack_file_name} CRC check failed")
+        for done in self.img_done:
+            done.set()
+        self.crc_done.set()
+
+    def crc_check(self):
+        # Wait for the pack CRC result, True right away if it was checked up front or skipped
+        self.crc_done.wait()
+        return self.crc_ok
+
+    def img_check(self, index, whole=False):
+        # Wait until the data of one image is known good. A v1 pack only has one CRC over everything,
+        # so that is waited for on the last image, or on any image if whole is set.
+        if self.version == 2:
+            self.img_done[index].wait()
+            return self.img_ok[index]
+        if whole is True or index == self.image_cnt - 1:
+            return self.crc_check()
+        return True
+
     def img_count(self):
         return self.image_cnt
 
@@ -54,12 +184,38 @@ class UnpackImage:
             print("Invalid image index")
             return 0, 0, 0
 
+    # COMPRESS_NONE for raw images, else the compression of the stored data. Always COMPRESS_NONE in a v1 pack.
+    def img_compress(self, index):
+        return self.img_list[index][4]
+
+    # SHA-256 of the programmed content, None in a v1 pack
+    def img_sha256(self, index):
+        return self.img_list[index][8]
+
+    # Index of the first run of the sparse image this entry is a run of, None if it is not one
+    def img_group(self, index):
+        group = self.img_list[index][9]
+        return None if group == NO_GROUP or group >= self.image_cnt else group
+
+    # Stored data of an image, compressed data for a compressed image
+    def img_stored(self, index):
+        return self.pack_view[self.img_list[index][3]: self.img_list[index][3] + self.img_list[index][5]]
+
     def img_content(self, index, offset, size):
         if index >= self.image_cnt:
             print("Invalid image index")
             return ''
-        if offset > self.img_list[index][0] or offset + size > self.img_list[index][0]:
+        if offset > self.img_list[index][5] or offset + size > self.img_list[index][5]:
             print("Invalid offset")
             return ''
 
-        return self.pack_data[self.img_list[index][3] + offset: self.img_list[index][3] + offset + size]
+        return self.pack_view[self.img_list[index][3] + offset: self.img_list[index][3] + offset + size]
+
+    def img_chunks(self, index, chunk_size, start=0, end=None):
+        end = self.img_list[index][0] if end is None else end
+        for offset in range(start, end, chunk_size):
+            size = min(chunk_size, end - offset)
+            # Hold back the last chunk of an image until its CRC has been checked
+            if offset + size == self.img_list[index][0] and not self.img_check(index):
+                return
+            yield self.img_content(index, offset, size)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Compare the CRC-32 backends of crc32.py on 1 MB to 4 GB of input.
+# Usage: python bench_crc.py [largest size in MB, default 4096]
+import os
+import sys
+import time
+import crc32
+
+BLOCK = 0x1000000   # Large inputs are fed incrementally in 16 MB blocks
+TIME_LIMIT = 30.0   # Skip sizes a backend is not expected to finish in this many seconds
+
+
+def run(backend, size, block):
+    crc32.set_backend(backend)
+    checksum = crc32.Crc32()
+    begin = time.perf_counter()
+    for offset in range(0, size, len(block)):
+        checksum.update(block[: min(len(block), size - offset)])
+    return checksum.get(), time.perf_counter() - begin
+
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    block = memoryview(os.urandom(BLOCK))
+    sizes = [mb for mb in (1, 16, 256, 1024, 4096) if mb <= max_mb]
+
+    print(f"{'Backend':<8} | {'Size (MB)':>9} | {'Time (s)':>9} | {'MB/s':>8} | {'CRC':<10}")
+    print("-" * 58)
+    for backend in crc32.BACKENDS:
+        rate = None
+        for mb in sizes:
+            if rate is not None and mb / rate > TIME_LIMIT:
+                print(f"{backend:<8} | {mb:>9} | {'skipped':>9} | {'':>8} |")
+                continue
+            checksum, elapsed = run(backend, mb << 20, block)
+            rate = mb / elapsed
+            print(f"{backend:<8} | {mb:>9} | {elapsed:>9.3f} | {rate:>8.0f} | {checksum:08x}")
+
+
+if __name__ == "__main__":
+    main()
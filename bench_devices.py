@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Attach and program 1 to 64 emulated devices at once and compare the aggregate throughput.
+# Each MockDevice takes data at a fixed rate, so the total should grow with the device count.
+# Usage: python bench_devices.py [max devices, default 64] [image MB, default 8] [MB/s per device, default 2]
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+
+MAX_DEVICES = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+IMAGE_MB = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+RATE_MB = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+CHUNK = 0x8000  # Large chunks keep the host side of the emulation cheap
+
+os.environ["NUWRITER_MOCK"] = "1"
+os.environ["NUWRITER_MOCK_RATE"] = str(RATE_MB * 0x100000)
+import nuwriter
+import MockDevice
+
+
+def run(count, image_file_name):
+    MockDevice.reset(count)
+    nuwriter.device_slots.clear()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        begin = time.perf_counter()
+        attached = nuwriter.do_attach("ddr.bin")
+        attach_time = time.perf_counter() - begin
+        begin = time.perf_counter()
+        programmed = nuwriter.do_img_program(nuwriter.DEV_SPINOR, 0, image_file_name)
+        program_time = time.perf_counter() - begin
+    if attached != 0 or programmed != 0:
+        sys.exit(output.getvalue())
+    return attach_time, program_time
+
+
+def main():
+    package = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp()
+    ddr = sorted(name for name in os.listdir(os.path.join(package, "ddrimg")) if name.endswith(".bin"))[0]
+    shutil.copy(os.path.join(package, "ddrimg", ddr), os.path.join(work, "ddr.bin"))
+    shutil.copy(os.path.join(package, "xusb.bin"), work)
+    with open(os.path.join(work, "image.bin"), "wb") as image_file:
+        image_file.write(os.urandom(IMAGE_MB << 20))
+    os.chdir(work)
+
+    nuwriter.mp_mode = True
+    nuwriter.chunk_size = CHUNK
+    counts = [count for count in (1, 8, 16, 32, 64, 128) if count <= MAX_DEVICES]
+    if MAX_DEVICES not in counts:
+        counts.append(MAX_DEVICES)
+
+    print(f"{IMAGE_MB} MB image, devices take {RATE_MB:.1f} MB/s each")
+    print(f"{'Devices':>7} | {'Attach (s)':>10} | {'Program (s)':>11} | {'Total MB/s':>10} | {'Scaling':>7}")
+    print("-" * 58)
+    try:
+        for count in counts:
+            attach_time, program_time = run(count, "image.bin")
+            rate = count * IMAGE_MB / program_time
+            print(f"{count:>7} | {attach_time:>10.2f} | {program_time:>11.2f} | {rate:>10.1f} | "
+                  f"{rate / RATE_MB / count * 100:>6.0f}%")
+    finally:
+        os.chdir(package)
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Compare buffer allocations of the program/verify chunk loops before and after memoryview.
+# Usage: python bench_memview.py [image size in MB]
+import sys
+import time
+import array
+import tracemalloc
+from nuwriter import same_data
+
+CHUNK = 4096
+
+
+# One loop step each, as __img_program runs it for every chunk
+def program_copy(img_data, offset, sink):
+    sink(img_data[offset: offset + CHUNK])
+
+
+def program_view(img_view, offset, sink):
+    sink(img_view[offset: offset + CHUNK])
+
+
+def verify_copy(img_data, offset, readback):
+    return readback != bytearray(img_data[offset: offset + CHUNK])
+
+
+def verify_view(img_view, offset, readback):
+    return not same_data(img_view[offset: offset + CHUNK], readback)
+
+
+def allocations(step, img_data, arg, length):
+    # tracemalloc peak grows by every chunk sized buffer alive during one step
+    count = 0
+    total = 0
+    tracemalloc.start()
+    for offset in range(0, length, CHUNK):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        step(img_data, offset, arg)
+        grown = tracemalloc.get_traced_memory()[1] - base
+        count += grown // CHUNK
+        total += grown
+    tracemalloc.stop()
+    return count, total
+
+
+def throughput(step, img_data, arg):
+    begin = time.perf_counter()
+    for offset in range(0, len(img_data), CHUNK):
+        step(img_data, offset, arg)
+    return len(img_data) / (time.perf_counter() - begin) / 0x100000
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    img_data = b'\x5A' * (size_mb << 20)
+    img_view = memoryview(img_data)
+    readback = array.array('B', b'\x5A' * CHUNK)    # What XUsbCom.read() hands back
+    sample = min(size_mb, 4)
+
+    print(f"{'Loop':<8} | {'Mode':<10} | {'Allocs/MB':>9} | {'KB alloc/MB':>11} | {'MB/s':>7}")
+    print("-" * 58)
+    for name, mode, step, data, arg in [("program", "copy", program_copy, img_data, len),
+                                        ("program", "memoryview", program_view, img_view, len),
+                                        ("verify", "copy", verify_copy, img_data, readback),
+                                        ("verify", "memoryview", verify_view, img_view, readback)]:
+        count, total = allocations(step, data, arg, sample << 20)
+        rate = throughput(step, data, arg)
+        print(f"{name:<8} | {mode:<10} | {count / sample:>9.0f} | {total / sample / 1024:>11.0f} | {rate:>7.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Program a run of emulated boards with mixed link speeds, in -m batches and with --station.
+# A batch waits for its slowest board before any is swapped, a station swaps each board when its port is done.
+# Usage: python bench_station.py [ports, default 4] [boards, default 16] [image MB, default 2]
+import io
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import contextlib
+
+PORTS = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+BOARDS = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+IMAGE_MB = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+SWAP_TIME = 1.0     # Seconds an operator takes to swap a board
+CHUNK = 0x8000
+
+os.environ["NUWRITER_MOCK"] = "0"
+import nuwriter
+import MockDevice
+
+rates = random.Random(1)
+
+
+def plug(index) -> None:
+    # Boards take 1 to 4 MB/s, like a fixture with mixed flash parts and cables
+    MockDevice.plug(index).rate = rates.uniform(1, 4) * 0x100000
+
+
+def command(image_file_name):
+    return ["-a", "ddr.bin", "-w", "spinor", "0", image_file_name, "-m", "--chunk-size", str(CHUNK)]
+
+
+def run_batches(image_file_name) -> float:
+    begin = time.perf_counter()
+    for first in range(0, BOARDS, PORTS):
+        MockDevice.reset(0)
+        for index in range(min(PORTS, BOARDS - first)):
+            plug(index)
+        nuwriter.device_slots.clear()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                nuwriter.main(command(image_file_name))
+            except SystemExit as err:
+                sys.exit(output.getvalue() + str(err))
+        time.sleep(SWAP_TIME)   # Swap the whole batch
+    return time.perf_counter() - begin
+
+
+class _Operator(io.StringIO):
+    # Reads the station output and swaps a board once its port reports a result
+
+    def write(self, text) -> int:
+        for port in re.findall(r"Port 1-(\d+) (?:passed|FAILED)", text):
+            MockDevice.unplug(int(port) - 1)
+            threading.Timer(SWAP_TIME, plug, args=(int(port) - 1,)).start()
+        return super().write(text)
+
+
+def run_station(image_file_name) -> float:
+    MockDevice.reset(0)
+    for index in range(PORTS):
+        plug(index)
+    nuwriter.device_slots.clear()
+    output = _Operator()
+    begin = time.perf_counter()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            nuwriter.main(command(image_file_name) + ["--station", str(BOARDS)])
+        except SystemExit as err:
+            sys.exit(output.getvalue() + str(err))
+    if "Successfully programmed" not in output.getvalue():
+        sys.exit(output.getvalue())
+    return time.perf_counter() - begin
+
+
+def main():
+    package = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp()
+    ddr = sorted(name for name in os.listdir(os.path.join(package, "ddrimg")) if name.endswith(".bin"))[0]
+    shutil.copy(os.path.join(package, "ddrimg", ddr), os.path.join(work, "ddr.bin"))
+    shutil.copy(os.path.join(package, "xusb.bin"), work)
+    with open(os.path.join(work, "image.bin"), "wb") as image_file:
+        image_file.write(os.urandom(IMAGE_MB << 20))
+    os.chdir(work)
+
+    print(f"{BOARDS} boards on {PORTS} ports, {IMAGE_MB} MB image, boards take 1 ~ 4 MB/s")
+    print(f"{'Mode':>8} | {'Time (s)':>8} | {'Boards/min':>10}")
+    print("-" * 33)
+    try:
+        for mode, run in (("-m", run_batches), ("station", run_station)):
+            rates.seed(1)
+            elapsed = run("image.bin")
+            print(f"{mode:>8} | {elapsed:>8.1f} | {BOARDS * 60 / elapsed:>10.1f}")
+    finally:
+        os.chdir(package)
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# NOTE: This script is test under Python 3.x
+
+__copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
+
+import zlib
+try:
+    import crcmod.predefined
+    from crcmod.crcmod import _usingExtension as crcmod_ext
+except ImportError:
+    crcmod = None
+
+# CRC-32 (poly 0x04C11DB7, reflected, init/xorout 0xFFFFFFFF) as used by the pack and header files.
+# Every backend is fn(data, crc) -> crc, where crc is the result over the previous data.
+BACKENDS = {'zlib': zlib.crc32}
+if crcmod is not None:
+    # crcmod silently falls back to pure Python when its C extension is not built
+    _crcmod_func = crcmod.predefined.mkCrcFun('crc-32')
+    if crcmod_ext is True:
+        BACKENDS['crcmod'] = _crcmod_func
+    else:
+        BACKENDS['python'] = _crcmod_func
+
+backend = 'zlib'
+
+
+def set_backend(name) -> None:
+    global backend
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown CRC-32 backend {name}, available: {', '.join(BACKENDS)}")
+    backend = name
+
+
+def crc32(data, crc=0) -> int:
+    return BACKENDS[backend](data, crc)
+
+
+def _gf2_times(mat, vec) -> int:
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def _gf2_square(mat) -> list:
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+# CRC of A + B from crc(A), crc(B) and len(B), same as zlib's crc32_combine() which Python does not expose
+def crc32_combine(crc1, crc2, len2) -> int:
+    if len2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << n for n in range(31)]   # Operator for one zero bit
+    even = _gf2_square(odd)     # Two zero bits
+    odd = _gf2_square(even)     # Four zero bits
+    while True:
+        # Apply len2 zero bytes to crc1, one bit of len2 at a time
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if len2 == 0:
+            break
+    return crc1 ^ crc2
+
+
+class Crc32:
+
+    def __init__(self, data=b''):
+        self.func = BACKENDS[backend]
+        self.value = self.func(data, 0)
+
+    def update(self, data) -> None:
+        self.value = self.func(data, self.value)
+
+    # Append data of length whose CRC was computed elsewhere, e.g. in another thread
+    def combine(self, crc, length) -> None:
+        self.value = crc32_combine(self.value, crc, length)
+
+    def get(self) -> int:
+        return self.value
+
+
+class ChunkCrc32:
+    # CRC-32 of every chunk_size bytes of a stream fed in pieces of any size
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.crcs = []
+        self.value = 0
+        self.length = 0     # Bytes in the current chunk
+
+    def update(self, data) -> None:
+        data = memoryview(data)
+        while len(data) > 0:
+            size = min(len(data), self.chunk_size - self.length)
+            self.value = crc32(data[:size], self.value)
+            self.length += size
+            data = data[size:]
+            if self.length == self.chunk_size:
+                self.crcs.append(self.value)
+                self.value = 0
+                self.length = 0
+
+    def get(self) -> list:
+        return self.crcs + ([self.value] if self.length > 0 else [])
@@ -115,21 +115,39 @@ class _Ui_ProgressDialog(object):
         
 class ProgressDialog(QtWidgets.QDialog, _Ui_ProgressDialog):
     updateRequested = QtCore.pyqtSignal(str, int, int, int, int)
+    ROWS = 16   # Bars per column, ports past the 8 of the form are added as they report
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setupUi(self)
+        self.bar_count = 8
         self.setModal(False)
         self.setWindowFlags(self.windowFlags() | QtCore.Qt.WindowStaysOnTopHint)
         self.updateRequested.connect(self.update_progress, QtCore.Qt.QueuedConnection)
         self.pushButton.clicked.connect(self.close)
 
+    def add_bars(self, count):
+        # Grow the dashboard to count ports, filling columns of ROWS bars
+        for bar_idx in range(self.bar_count + 1, count + 1):
+            row, column = (bar_idx - 1) % self.ROWS, (bar_idx - 1) // self.ROWS * 2
+            label = QtWidgets.QLabel(self)
+            label.setMinimumSize(QtCore.QSize(80, 0))
+            label.setText(f"Port {bar_idx}: Progress")
+            bar = QtWidgets.QProgressBar(self)
+            bar.setProperty("value", 0)
+            self.gridLayout.addWidget(label, row, column, 1, 1)
+            self.gridLayout.addWidget(bar, row, column + 1, 1, 1)
+            setattr(self, f"label_{bar_idx}", label)
+            setattr(self, f"progressBar_{bar_idx}", bar)
+        self.bar_count = max(self.bar_count, count)
+
     @QtCore.pyqtSlot(str, int, int, int, int)
     def update_progress(self, bar_type: str, bar_idx: int, percent: int, img_i: int, img_x: int):
-        if not (1 <= bar_idx <= 8):
-            raise IndexError(f"bar_idx must be between 1 and 8 (got {bar_idx})")
+        if bar_idx < 1:
+            raise IndexError(f"bar_idx must be at least 1 (got {bar_idx})")
         if not (0 <= percent <= 100):
             raise ValueError("percent must be between 0 and 100")
+        self.add_bars(bar_idx)
 
         getattr(self, f"progressBar_{bar_idx}").setValue(percent)
         if img_i == 0 and img_x == 0:
@@ -141,7 +159,7 @@ class ProgressDialog(QtWidgets.QDialog, _Ui_ProgressDialog):
             getattr(self, f"label_{bar_idx}").setText(f"Port {bar_idx}: Success")
         
     def progress_reset(self):
-        for bar_idx in range(1, 9):
+        for bar_idx in range(1, self.bar_count + 1):
             getattr(self, f"progressBar_{bar_idx}").setValue(0)
             getattr(self, f"label_{bar_idx}").setText(f"Port {bar_idx}: Progress")
 
@@ -8,7 +8,6 @@ import os
 import sys
 import argparse
 import json
-import crcmod
 from Crypto.Cipher import AES
 import hashlib
 import ecdsa
@@ -19,22 +18,50 @@ from datetime import datetime
 import random
 import shutil
 from tqdm import tqdm
-from xusbcom import XUsbComList
+from xusbcom import XUsbCom, XUsbComList, split_chunks, find_devices, save_config, MAX_XFER_LEN, VID, PID
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from UnpackImage import UnpackImage
+from UnpackImage import UnpackImage, PACK_MARKER, PACK_V2_MARKER, PACK_V2_ENTRY, NO_GROUP
+from BlockMap import BlockMap, find_bmap, create_bmap
+from SparseImage import SparseImage, is_sparse
+from StreamImage import StreamImage, compressor, file_compress_type, COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_ZSTD, \
+    STREAM_SEGMENT
+from crc32 import crc32, Crc32, ChunkCrc32
+import collections
 from collections import namedtuple
 from struct import unpack
 import time
 import platform
+import mmap
+import socket
+import socketserver
+import contextlib
+import threading
+import traceback
+import hmac
+import secrets
 # for debug
 import usb.core
 import usb.util
 
 ACK = 0x55AA55AA
 TRANSFER_SIZE = 4096
+# Chunk size 0 means auto tune, probe these sizes on the first image of each device and media
+CHUNK_AUTO = 0
+PROBE_CHUNK_SIZES = [4096, 8192, 16384, 32768]
+PROBE_LENGTH = 0x100000     # Image bytes sent with each probed chunk size
 MAX_HEADER_IMG = 4
+PACK_BLOCK = 0x100000    # Image data is copied into pack.bin in blocks of this size
+PREFETCH_WORKERS = 16       # Input images read ahead concurrently while building pack.bin
+PREFETCH_LIMIT = 0x2000000  # Larger input images are streamed by the writer instead of read ahead
+PREFETCH_BUDGET = 0x4000000 # Bytes of input images read ahead at most
+PACK_CRC_CHUNK = 0x100000   # Pack v2 keeps a CRC32 for every this many bytes of stored image data
+PACK_COMPRESS = {"none": COMPRESS_NONE, "zlib": COMPRESS_ZLIB, "zstd": COMPRESS_ZSTD}   # "compress" in pack v2 json
 # SPI NOR align for erase/program starting address
 SPINOR_ALIGN = 4096
+STATION_POLL = 0.2          # Seconds between looks for boards plugged into a --station
+STATION_WORKERS = 127       # Boards a station works on at once, as many as one USB bus takes
+PORT_MAP_FILE = "ports.txt" # Optional "port path, fixture label" lines, the ports take slots in line order
+REPORT_INTERVAL = 0.1       # Seconds between the reporter thread's samples of progress, 10 Hz
 
 # Storage device type
 DEV_DDR_SRAM = 0
@@ -69,6 +96,8 @@ OPT_CONCAT = 9      # For convert, concatenate at the end of encrypted data file
 OPT_SHOWHDR = 10    # For convert. Instead of convert, show header content instead
 OPT_NOCRC = 11      # For pack. unpack file without crc32 check
 OPT_CONVOTP = 12    # For convert. convert otp.json to otp.bin
+OPT_BGCRC = 13      # For pack. check crc32 in background while programming
+OPT_BMAP = 14       # For convert. generate block map sidecar of a disk image
 OPT_DDR_INIT = 1    # For ddr
 OPT_DDR_800 = 2     # For ddr, ddr_pll
 OPT_DDR_667 = 3     # For ddr, ddr_pll
@@ -116,35 +145,213 @@ IMG_DTB = 6
 # If attach is a must. maybe better for real chip.
 # devices = []
 mp_mode = False
-bus_arr = [0, 0, 0, 0, 0, 0, 0, 0]
-address_arr = [0, 0, 0, 0, 0, 0, 0, 0]
+# Transfer chunks kept in flight before their acks are checked, 1 is lock-step
+xfer_window = 1
+# Chunk size used to program flash media, TRANSFER_SIZE unless --chunk-size is given
+chunk_size = TRANSFER_SIZE
+# Chunk size probes cut short by the end of an image, {(port, media): (sizes left, best size, best rate)}.
+# The next image of this command probes the sizes left.
+chunk_probe = {}
+# Leave trailing all 0xFF blocks out when programming NAND/SPI NAND, set by --skip-erased
+skip_erased = False
+# Program gzip/xz/zstd images decompressed, set by --decompress
+decompress = False
+# Slot of every device seen, {port: slot}, or {(bus, address): slot} if the backend can't tell ports
+device_slots = {}
+slot_lock = threading.Lock()
+# Fixture labels of ports from PORT_MAP_FILE, {port: label} in slot order. None until loaded.
+port_labels = None
+# Boards run through the pipeline by this command, {port: [passed, failed, seconds]}
+slot_stats = {}
+# Called with every event dict, see set_event_sink(). None sends no events.
+event_sink = None
+# Draw tqdm progress bars, the GUI leaves them out when it shows progress from events
+progress_bars = True
+# Progress being counted by device threads, drawn and sent by one reporter thread
+progress_active = []
+progress_lock = threading.Lock()
+progress_reporter = None
+
+# Devices kept open between the commands of --daemon, {"devices": XUsbComList or None, "attached": bool}
+session = None
+# (name, phase) each device goes through before the work of a command, a phase returns the device to
+# carry on with or None on failure. Set to attach and erase along with programming by -a and --erase-first.
+device_phases = []
+# Devices attached by the attach phases of this command
+attached_devices = None
+# Boards a --station programs before it stops, 0 for no end. None when not a station.
+station = None
+# --daemon/--connect default, [loopback host:]port or a Unix socket path. POSIX gets a socket only its user may open.
+if os.name == 'posix':
+    DAEMON_ADDRESS = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~"), ".nuwriter-daemon.sock")
+else:
+    DAEMON_ADDRESS = "127.0.0.1:50963"
+# A TCP daemon writes a new token here when it starts, --connect reads it to prove it runs as the same user
+DAEMON_TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".nuwriter-daemon-token")
 
 WINDOWS_PATH = "C:\\Program Files (x86)\\Nuvoton Tools\\NuWriter\\"
 LINUX_PATH = "/usr/share/nuwriter/"
 
-def bus_address(bus, address):
-    global bus_arr
-    global address_arr
-    
-    for i in range(8):
-        if bus_arr[i] == bus and address_arr[i] == address:
-            return i
-    for j in range(8):
-        if bus_arr[j] == 0 and address_arr[j] == 0:
-            bus_arr[j] = bus
-            address_arr[j] = address
-            return j
-    return -1
-    
-def reset_bus_address(bus, address):
-    global bus_arr
-    global address_arr
-    
-    bus_arr[0] = bus
-    address_arr[0] = address
-    for i in range(1, 8):
-        bus_arr[i] = 0
-        address_arr[i] = 0
+def load_port_map(file_path) -> dict:
+    labels = {}
+    if not os.path.exists(file_path):
+        return labels
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                port, label = line.split(",")
+                labels[port.strip()] = label.strip()
+            except ValueError:
+                print(f"format error {line}")
+    return labels
+
+
+def port_label(port) -> str:
+    global port_labels
+
+    with slot_lock:
+        if port_labels is None:
+            port_labels = load_port_map(PORT_MAP_FILE)
+        return port_labels.get(port, '')
+
+
+def __port_name(port) -> str:
+    return f"{port} ({port_label(port)})" if port_label(port) != '' else port
+
+
+def device_slot(dev) -> int:
+    # Slot of a device, its progress bar position and the N of "device N". It comes from the port
+    # path, so a socket of a fixture keeps its slot across runs and when its board re-enumerates.
+    port = dev.port_key()
+    port_label(port)
+    with slot_lock:
+        if port == '':
+            # Without port paths a new device takes the lowest free slot
+            port = (dev.get_bus(), dev.get_address())
+            if port not in device_slots:
+                used = set(device_slots.values())
+                device_slots[port] = min(slot for slot in range(len(used) + 1) if slot not in used)
+        elif port not in device_slots:
+            if port in port_labels:
+                device_slots[port] = list(port_labels).index(port)
+            else:
+                device_slots[port] = XUsbCom.port_slot(port, len(port_labels))
+        return device_slots[port]
+
+
+# Take progress and results as event dicts instead of parsing the bars. sink is called from the device
+# threads with {"time", "event", "slot", ...}:
+#   phase     phase: a pipeline phase of the device begins
+#   progress  phase, image, images, done, total (None if unknown), unit "B" or "%", mbps
+#   result    port, label, result "passed" or "failed", seconds: the device is done
+def set_event_sink(sink, bars=True) -> None:
+    global event_sink
+    global progress_bars
+
+    event_sink = sink
+    progress_bars = bars
+
+
+def _send_event(event, slot, **fields) -> None:
+    if event_sink is not None:
+        event_sink(dict(time=round(time.time(), 3), event=event, slot=slot, **fields))
+
+
+def _json_events(stream):
+    # --events json, one JSON object per line
+    lock = threading.Lock()
+
+    def sink(event):
+        line = json.dumps(event) + "\n"
+        with lock:
+            stream.write(line)
+            stream.flush()
+    return sink
+
+
+class _Progress:
+    # Progress of one device in one phase. The device thread only adds to done, the reporter
+    # thread samples it to draw the tqdm bar and send events, so transfers never wait on output.
+
+    def __init__(self, slot, phase, total, image=0, images=0, unit='B', **bar):
+        global progress_reporter
+
+        self.slot = slot
+        self.phase = phase
+        self.total = total
+        self.image = image
+        self.images = images
+        self.unit = unit
+        self.done = 0
+        self.sent = 0
+        self.sent_time = time.monotonic()
+        with progress_lock:
+            self.bar = tqdm(total=total, position=slot, ascii=True, unit=unit, disable=not progress_bars, **bar)
+            self.report(True)
+            progress_active.append(self)
+            if progress_reporter is None:
+                progress_reporter = threading.Thread(target=_report_progress, daemon=True)
+                progress_reporter.start()
+
+    def update(self, size) -> None:
+        self.done += size
+
+    def close(self) -> None:
+        with progress_lock:
+            if self not in progress_active:
+                return
+            progress_active.remove(self)
+            self.report(True)
+            self.bar.close()
+
+    # A bar used in a with block is closed however the transfer ends, a failed device does not leave it behind
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        self.close()
+
+    # Draw what was done since the last report and send it as an event. Call with progress_lock held.
+    def report(self, always=False) -> None:
+        done = self.done
+        if done == self.sent and always is False:
+            return
+        now = time.monotonic()
+        self.bar.update(done - self.sent)
+        # Rate since the last report, not the average of the whole phase
+        mbps = (done - self.sent) / (now - self.sent_time) / 1e6 if now > self.sent_time else 0.0
+        _send_event("progress", self.slot, phase=self.phase, image=self.image, images=self.images,
+                    done=done, total=self.total, unit=self.unit, mbps=round(mbps, 2) if self.unit == 'B' else None)
+        self.sent = done
+        self.sent_time = now
+
+
+def _report_progress() -> None:
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        with progress_lock:
+            for progress in progress_active:
+                progress.report()
+
+
+def __slot_summary() -> None:
+    # Boards of this command per slot next to all runs so far, slow or failing sockets stand out
+    totals = XUsbCom.add_stats(slot_stats)
+    if len(slot_stats) < 2 and station is None:
+        return
+    print(f"{'Slot':>4} {'Port':<14} {'Label':<10} {'Passed':>6} {'Failed':>6} {'Avg (s)':>7} | "
+          f"{'Boards':>6} {'Yield':>6} {'Avg (s)':>7}")
+    for port in sorted(slot_stats, key=lambda key: device_slots.get(key, 0)):
+        passed, failed, seconds = slot_stats[port]
+        total = totals[port]
+        print(f"{device_slots.get(port, 0):>4} {port:<14} {port_label(port):<10} {passed:>6} {failed:>6} "
+              f"{seconds / (passed + failed):>7.1f} | {total[0] + total[1]:>6} "
+              f"{total[0] * 100 / (total[0] + total[1]):>5.0f}% {total[2] / (total[0] + total[1]):>7.1f}")
+
 
 def switch_mp_mode(flag):
     global mp_mode
@@ -166,8 +373,7 @@ def conv_env(env_file_name, blk_size) -> bytearray:
     out += b'\x00'
     out += b'\xFF' * (blk_size - len(out))
 
-    crc32_func = crcmod.predefined.mkCrcFun('crc-32')
-    checksum = crc32_func(out[4:])
+    checksum = crc32(out[4:])
     out[0:4] = checksum.to_bytes(4, byteorder="little")
 
     return out
@@ -573,6 +779,244 @@ def conv_otp(opt_file_name) -> (bytearray, int):
     return data, option
 
 
+def __open_devices(attach_all) -> XUsbComList:
+    # A station finds its boards as they are plugged in
+    if station is not None:
+        return XUsbComList(previous=[])
+    # A daemon session enumerates once and keeps its devices open across commands
+    if session is None:
+        return XUsbComList(attach_all=attach_all)
+    if session["devices"] is None:
+        session["devices"] = XUsbComList(attach_all=attach_all)
+    return session["devices"]
+
+
+def __keep_devices(device_list) -> None:
+    # Devices just loaded with xusb, later commands of a daemon session use them without attaching again
+    if session is not None:
+        session["devices"] = device_list
+        session["attached"] = True
+
+
+def __device_pipeline(dev, phases, work, *args) -> int:
+    port = dev.port_key()
+    slot = device_slot(dev)
+    begin = time.monotonic()
+    status = -1
+    try:
+        for name, phase in phases:
+            _send_event("phase", slot, phase=name)
+            dev = phase(dev)
+            if dev is None:
+                print(f"{name} failed")
+                return status
+        status = work(dev, *args)
+        return status
+    finally:
+        seconds = time.monotonic() - begin
+        if port != '':
+            with slot_lock:
+                stats = slot_stats.setdefault(port, [0, 0, 0.0])
+                stats[0 if status == 0 else 1] += 1
+                stats[2] += seconds
+        _send_event("result", slot, port=port, label=port_label(port), result="passed" if status == 0 else "failed",
+                    seconds=round(seconds, 3))
+
+
+# Run every device through the phases then the work in its own thread, each moves on to its
+# next phase without waiting for the others
+def __run_devices(devices, phases, work, *args) -> (int, int):
+    if station is not None:
+        return __run_station(phases, work, *args)
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
+        futures = [executor.submit(__device_pipeline, dev, phases, work, *args) for dev in devices]
+    success = 0
+    failed = 0
+    for future in as_completed(futures):
+        if future.result() == 0:
+            success += 1
+        else:
+            failed += 1
+    return success, failed
+
+
+# Status and the address the board ended up at, a different address on its port is the next board
+def __station_board(dev, port, phases, work, *args) -> (int, int):
+    try:
+        status = __device_pipeline(dev, phases, work, *args)
+    except SystemExit as err:
+        # A USB error fails this board, not the station
+        print(f"Port {__port_name(port)}: {err}")
+        status = -1
+    # Let go of the board's handles, the port takes the next one
+    try:
+        usb.util.dispose_resources(dev.dev)
+    except usb.core.USBError:
+        pass
+    address = dev.get_address()
+    if attached_devices is not None:
+        address = next((xusb.get_address() for xusb in attached_devices.get_dev() if xusb.port_key() == port),
+                       address)
+        attached_devices.release(port)
+    return status, address
+
+
+# Run each board plugged in through the phases then the work as soon as it shows up, until stopped
+# or the given number of boards is done
+def __run_station(phases, work, *args) -> (int, int):
+    busy = {}       # {port: (future, start time)}
+    done = {}       # {port: address} of boards finished but still plugged in
+    success = 0
+    failed = 0
+    print("Station ready, plug in boards" + (f", stop after {station}" if station > 0 else ", Ctrl-C to stop"))
+    with ThreadPoolExecutor(max_workers=STATION_WORKERS) as executor:
+        try:
+            while station == 0 or success + failed < station:
+                for port, (future, begin) in list(busy.items()):
+                    if future.done():
+                        del busy[port]
+                        status, done[port] = future.result()
+                        if status == 0:
+                            success += 1
+                            print(f"Port {__port_name(port)} passed in {time.monotonic() - begin:.1f}s")
+                        else:
+                            failed += 1
+                            print(f"Port {__port_name(port)} FAILED after {time.monotonic() - begin:.1f}s")
+                        # A station runs for hours, keep what the board added to the registry
+                        if save_config() is False:
+                            print("Write .config failed")
+
+                try:
+                    found = list(find_devices(idVendor=VID, idProduct=PID, find_all=True))
+                except usb.core.NoBackendError as err:
+                    sys.exit(err)
+                present = set()
+                for usb_dev in found:
+                    dev = XUsbCom(usb_dev)
+                    port = dev.port_key()
+                    if port == '':
+                        print("Cannot tell which port a device is on, station mode needs port numbers")
+                        sys.exit(2)
+                    present.add(port)
+                    if port in busy or done.get(port) == usb_dev.address or \
+                       (station > 0 and success + failed + len(busy) >= station):
+                        continue
+                    try:
+                        usb_dev.set_configuration()
+                    except (usb.core.USBError, NotImplementedError):
+                        continue    # Still enumerating
+                    dev.set_bus(usb_dev.bus)
+                    dev.set_address(usb_dev.address)
+                    print(f"Port {__port_name(port)} board plugged in")
+                    busy[port] = (executor.submit(__station_board, dev, port, phases, work, *args), time.monotonic())
+                done = {port: address for port, address in done.items() if port in present}
+                time.sleep(STATION_POLL)
+        except KeyboardInterrupt:
+            print(f"Station stopping, waiting for {len(busy)} board(s) in progress")
+            for port, (future, begin) in busy.items():
+                if future.result()[0] == 0:
+                    success += 1
+                else:
+                    failed += 1
+    return success, failed
+
+
+def same_data(expect, data) -> bool:
+    # Compare a view of the image with the read back array in place. Views of bytes compare
+    # item by item, so compare 8 bytes per item and only the tail byte by byte.
+    if len(expect) != len(data):
+        return False
+    aligned = len(data) & ~7
+    data = memoryview(data)
+    return expect[:aligned].cast('Q') == data[:aligned].cast('Q') and expect[aligned:] == data[aligned:]
+
+
+def __probe_chunk_size(dev, media, chunks, img_length, progress) -> (int, int):
+    # Send the head of the image with each candidate chunk size and time it. Return the
+    # image offset reached and the fastest size xusb accepted, or -1 if a size was rejected.
+    # The fastest size so far is recorded even if the image ran out before every size was timed.
+    key = (dev.geometry_key(), media)
+    sizes, best_size, best_rate = chunk_probe.pop(key, (PROBE_CHUNK_SIZES, TRANSFER_SIZE, 0))
+    offset = 0
+    for index, size in enumerate(sizes):
+        length = min(PROBE_LENGTH, img_length - offset)
+        length -= length % size
+        if length < size * 4:
+            # Not enough image left to measure, the next image goes on from this size
+            chunk_probe[key] = (sizes[index:], best_size, best_rate)
+            break
+        begin = time.perf_counter()
+        if dev.write_chunks(chunks(size, offset, offset + length), xfer_window, progress) != 0:
+            # Keep the sizes that worked, next run programs without probing
+            dev.set_chunk_size(media, best_size)
+            print(f"Chunk size {size} rejected, {best_size} recorded for next run")
+            return offset, -1
+        rate = length / (time.perf_counter() - begin)
+        if rate > best_rate:
+            best_rate = rate
+            best_size = size
+        offset += length
+    if offset > 0:
+        dev.set_chunk_size(media, best_size)
+        if key in chunk_probe:
+            print(f"Chunk size {best_size} recorded, {len(chunk_probe[key][0])} size(s) left to probe")
+        else:
+            print(f"Chunk size {best_size} selected, {best_rate / 0x100000:.1f} MB/s")
+    return offset, best_size
+
+
+def __write_image(dev, media, chunks, img_length, progress) -> int:
+    # Stream one image with the chunk size chosen for this device and media, probing it first if needed
+    offset = 0
+    size = chunk_size
+    if size == CHUNK_AUTO:
+        size = dev.get_chunk_size(media)
+        if size == 0 or (dev.geometry_key(), media) in chunk_probe:
+            offset, size = __probe_chunk_size(dev, media, chunks, img_length, progress)
+            if size == -1:
+                return -1
+    return dev.write_chunks(chunks(size, offset, img_length), xfer_window, progress)
+
+
+def __data_runs(img_data, block) -> list:
+    # The (offset, length) run of the image up to its last block holding data, trailing all 0xFF blocks are
+    # left out. Erased blocks inside the image are still sent, xusb skips bad blocks within one write command
+    # only and a gap would shift the blocks after it differently from a whole image write.
+    erased = memoryview(b'\xFF' * block)
+    length = len(img_data)
+    while length > 0:
+        offset = (length - 1) // block * block
+        if not same_data(erased[:length - offset], img_data[offset: length]):
+            break
+        length = offset
+    return [(0, length)] if length > 0 else []
+
+
+def __write_runs(dev, media, start, runs, cmd_option, chunks, img_length, progress) -> int:
+    # Program each run with its own write command, chunks(size, begin, end) slices the whole image.
+    # cmd_option goes with the last run only, the image is executed once all of it is written.
+    written = 0
+    for i, (offset, length) in enumerate(runs):
+        progress(offset - written)     # Erased blocks skipped
+        cmd = (start + offset).to_bytes(8, byteorder='little')
+        cmd += length.to_bytes(8, byteorder='little')
+        cmd += ACT_WRITE.to_bytes(4, byteorder='little')
+        cmd += (cmd_option if i == len(runs) - 1 else 0).to_bytes(4, byteorder='little')
+
+        dev.set_media(media)
+        ack = dev.command(cmd)
+        if int.from_bytes(ack, byteorder="little") != ACK:
+            print("Receive ACK error")
+            return -1
+        run_chunks = lambda size, begin, end, base=offset: chunks(size, base + begin, base + end)
+        if __write_image(dev, media, run_chunks, length, progress) != 0:
+            return -1
+        dev.read(4)
+        written = offset + length
+    progress(img_length - written)
+    return 0
+
+
 def __img_erase(dev, media, start, length, option) -> int:
 
     nand_align, spinand_align, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block = dev.get_align()
@@ -605,22 +1049,18 @@ def __img_erase(dev, media, start, length, option) -> int:
         print("Receive ACK error")
         return -1
         
-    dev_num = bus_address(dev.get_bus(),dev.get_address())
-    if  dev_num == -1:
-        reset_bus_address(dev.get_bus(),dev.get_address())
-        dev_num = 0
+    dev_num = device_slot(dev)
         
-    bar = tqdm(total=100, position=dev_num, ascii=True, bar_format='{l_bar}{bar:10}{bar:-10b}')
-    previous_progress = 0
-    while True:
-        # xusb ack with total erase progress.
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") <= 100:
-            bar.update(int.from_bytes(ack, byteorder="little") - previous_progress)
-            previous_progress = int.from_bytes(ack, byteorder="little")
-        if int.from_bytes(ack, byteorder="little") == 100:
-            break
-    bar.close()
+    with _Progress(dev_num, "Erasing", 100, unit='%', bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+        previous_progress = 0
+        while True:
+            # xusb ack with total erase progress.
+            ack = dev.read(4)
+            if int.from_bytes(ack, byteorder="little") <= 100:
+                bar.update(int.from_bytes(ack, byteorder="little") - previous_progress)
+                previous_progress = int.from_bytes(ack, byteorder="little")
+            if int.from_bytes(ack, byteorder="little") == 100:
+                break
     return 0
 
 
@@ -629,22 +1069,15 @@ def do_img_erase(media, start, length=0, option=OPT_NONE) -> None:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
-    if len(devices) == 0:
+    if len(devices) == 0 and station is None:
         print("Device not found")
         sys.exit(2)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__img_erase, dev, media, start, length, option) for dev in devices]
-    success = 0
-    failed = 0
-    for future in as_completed(futures):
-        if future.result() == 0:
-            success += 1
-        else:
-            failed += 1
+    success, failed = __run_devices(devices, device_phases, __img_erase, media, start, length, option)
+    __slot_summary()
 
     print(f"Successfully erased {success} device(s)")
     if failed > 0:
@@ -655,7 +1088,7 @@ def do_otp_erase(option) -> None:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
@@ -717,13 +1150,8 @@ def load_otp_writer(dev) -> int:
         print("Receive ACK error")
         return -1
 
-    for offset in range(0, img_length, TRANSFER_SIZE):
-        xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < img_length else img_length - offset
-        dev.write(otp_writer[offset: offset + xfer_size])
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") != xfer_size:
-            print("Acked size error")
-            return -1
+    if dev.write_chunks(split_chunks(otp_writer, TRANSFER_SIZE), xfer_window) != 0:
+        return -1
 
     while True:
         # wait TSI update firmware
@@ -767,7 +1195,7 @@ def do_otp_program(opt_file_name) -> None:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
@@ -777,7 +1205,7 @@ def do_otp_program(opt_file_name) -> None:
     load_otp_writer(devices[0])
     otp_data, option = conv_otp(opt_file_name)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
         futures = [executor.submit(__otp_program, dev, otp_data, option) for dev in devices]
     success = 0
     failed = 0
@@ -796,7 +1224,7 @@ def do_otp_read(media, start, out_file_name, length=0x1, option=OPT_NONE) -> Non
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
@@ -819,27 +1247,25 @@ def do_otp_read(media, start, out_file_name, length=0x1, option=OPT_NONE) -> Non
         print("Receive ACK error")
         return
     # FIXME: Don't know real length for "read all"
-    bar = tqdm(total=length, ascii=True, bar_format='{l_bar}{bar:10}{bar:-10b}')
-    data = b''
-    remain = length
-
-    while remain > 0:
-        ack = dev.read(4)
-        # Get the transfer length of next read
-        xfer_size = int.from_bytes(ack, byteorder="little")
+    with _Progress(device_slot(dev), "Reading", length, bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+        data = b''
+        remain = length
 
-        data += dev.read(xfer_size)
-        dev.write(xfer_size.to_bytes(4, byteorder='little'))    # ack
-        remain -= xfer_size
-        bar.update(xfer_size)
-    try:
-        with open(out_file_name, "wb") as out_file:
-            out_file.write(data[0:length])
-    except (IOError, OSError) as err:
-        print(f"Open {out_file_name} failed")
-        sys.exit(err)
+        while remain > 0:
+            ack = dev.read(4)
+            # Get the transfer length of next read
+            xfer_size = int.from_bytes(ack, byteorder="little")
 
-    bar.close()
+            data += dev.read(xfer_size)
+            dev.write(xfer_size.to_bytes(4, byteorder='little'))    # ack
+            remain -= xfer_size
+            bar.update(xfer_size)
+        try:
+            with open(out_file_name, "wb") as out_file:
+                out_file.write(data[0:length])
+        except (IOError, OSError) as err:
+            print(f"Open {out_file_name} failed")
+            sys.exit(err)
 
 
 def __pack_program(dev, media, pack_image, option) -> int:
@@ -852,46 +1278,74 @@ def __pack_program(dev, media, pack_image, option) -> int:
         print("Unable to get block size")
         return -1
 
+    dev.ready_wait = 0.0
+    begin = time.perf_counter()
     for i in range(image_cnt):
         img_length, img_start, img_type = pack_image.img_attr(i)
+        # All runs of a sparse image go in the write command of its first run on NAND and SPI NAND,
+        # that starts from the block the run is in
+        group = pack_image.img_group(i) if media in (DEV_NAND, DEV_SPINAND) else None
+        if group is not None and group != i:
+            continue
+        if group is not None:
+            img_start -= img_start % (nand_align if media == DEV_NAND else spinand_align)
         if (media == DEV_NAND and img_start % nand_align != 0) or \
            (media == DEV_SPINAND and img_start % spinand_align != 0) or \
            (media == DEV_SPINOR and img_start % SPINOR_ALIGN != 0):
             print("Starting address must be block aligned")
             return -1
-        time.sleep(1)
-        dev.set_media(media)
-        cmd = img_start.to_bytes(8, byteorder='little')
-        cmd += img_length.to_bytes(8, byteorder='little')
-        cmd += ACT_WRITE.to_bytes(4, byteorder='little')
-        cmd += img_type.to_bytes(4, byteorder='little')
+        dev_num = device_slot(dev)
 
-        dev.write(cmd)
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") != ACK:
-            print("Receive ACK error")
-            return -1
-            
-        dev_num = bus_address(dev.get_bus(),dev.get_address())
-        if dev_num == -1:
-            reset_bus_address(dev.get_bus(),dev.get_address())
-            dev_num = 0
-            
         text = f"device {dev_num} Programming {i+1}/{image_cnt}"
-        bar = tqdm(total=img_length, position=dev_num, ascii=True, desc=text, bar_format='{l_bar}{bar:10}{bar:-10b}')
-        for offset in range(0, img_length, TRANSFER_SIZE):
-            xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < img_length else img_length - offset
-            dev.write(pack_image.img_content(i, offset, xfer_size))
-            ack = dev.read(4)
-            if int.from_bytes(ack, byteorder="little") != xfer_size:
-                print("Ack size error")
+        if group is not None:
+            members = [j for j in range(i, image_cnt) if pack_image.img_group(j) == i]
+            if __group_program(dev, media, pack_image, members, option, f"Programming {i+1}/{image_cnt}") != 0:
                 return -1
-            bar.update(xfer_size)
-        bar.close()
-        dev.read(4)
+            continue
+        chunks = lambda size, begin, end: pack_image.img_chunks(i, size, begin, end)
+        if pack_image.img_compress(i) != COMPRESS_NONE:
+            # Stored data goes through the decompressor instead of being held back, so the CRC has to pass first
+            if pack_image.img_check(i, option == OPT_VERIFY) is False:
+                print("Pack CRC check failed")
+                return -1
+            if __stream_program(dev, media, img_start, pack_image.img_stored(i), option, img_type,
+                                f"Programming {i+1}/{image_cnt}", pack_image.img_compress(i),
+                                pack_image.img_sha256(i), img_length) != 0:
+                return -1
+            continue
+        # Boot images are laid out by xusb from their type, only plain data images are split
+        if skip_erased is True and media in (DEV_NAND, DEV_SPINAND) and img_type == IMG_DATA:
+            # The held back last chunk may fall in a skipped block, so check the CRC up front
+            if pack_image.img_check(i, option == OPT_VERIFY) is False:
+                print("Pack CRC check failed")
+                return -1
+            runs = __data_runs(pack_image.img_content(i, 0, img_length),
+                               nand_align if media == DEV_NAND else spinand_align)
+            with _Progress(dev_num, "Programming", img_length, i + 1, image_cnt, desc=text,
+                           bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+                if __write_runs(dev, media, img_start, runs, img_type, chunks, img_length, bar.update) != 0:
+                    return -1
+        else:
+            dev.set_media(media)
+            cmd = img_start.to_bytes(8, byteorder='little')
+            cmd += img_length.to_bytes(8, byteorder='little')
+            cmd += ACT_WRITE.to_bytes(4, byteorder='little')
+            cmd += img_type.to_bytes(4, byteorder='little')
 
-        # FIXME: Added time.sleep(1) to make SPI NAND Pack Program + Verify PASS
-        time.sleep(1)
+            ack = dev.command(cmd)
+            if int.from_bytes(ack, byteorder="little") != ACK:
+                print("Receive ACK error")
+                return -1
+
+            with _Progress(dev_num, "Programming", img_length, i + 1, image_cnt, desc=text,
+                           bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+                if __write_image(dev, media, chunks, img_length, bar.update) != 0:
+                    return -1
+            # Last chunk of the image is not sent if the background CRC check failed. Verify waits for it too.
+            if pack_image.img_check(i, option == OPT_VERIFY) is False:
+                print("Pack CRC check failed")
+                return -1
+            dev.read(4)
 
         if option == OPT_VERIFY:
             dev.set_media(media)
@@ -900,40 +1354,104 @@ def __pack_program(dev, media, pack_image, option) -> int:
             cmd += ACT_READ.to_bytes(4, byteorder='little')
             cmd += b'\x00' * 4
 
-            dev.write(cmd)
-            ack = dev.read(4)
+            ack = dev.command(cmd)
             if int.from_bytes(ack, byteorder="little") != ACK:
                 print("Receive ACK error")
                 return -1
             remain = img_length
             
-            dev_num = bus_address(dev.get_bus(),dev.get_address())
-            if dev_num == -1:
-                reset_bus_address(dev.get_bus(),dev.get_address())
-                dev_num = 0
+            dev_num = device_slot(dev)
                 
             text = f"device {dev_num} Verifying {i}/{image_cnt}"
-            bar = tqdm(total=img_length, position=dev_num, ascii=True, desc=text, bar_format='{l_bar}{bar:10}{bar:-10b}')
-            while remain > 0:
-                ack = dev.read(4)
-                # Get the transfer length of next read
-                xfer_size = int.from_bytes(ack, byteorder="little")
-
-                data = dev.read(xfer_size)
-                dev.write(xfer_size.to_bytes(4, byteorder='little'))
-                offset = img_length - remain
-
-                # For SD/eMMC
-                if xfer_size > remain:
-                    xfer_size = remain
-                    data = data[0: remain]
-
-                if data != bytearray(pack_image.img_content(i, offset, xfer_size)):
-                    print("Verify failed")
-                    return -1
-                remain -= xfer_size
-                bar.update(xfer_size)
-            bar.close()
+            with _Progress(dev_num, "Verifying", img_length, i + 1, image_cnt, desc=text,
+                           bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+                while remain > 0:
+                    ack = dev.read(4)
+                    # Get the transfer length of next read
+                    xfer_size = int.from_bytes(ack, byteorder="little")
+
+                    data = dev.read(xfer_size)
+                    dev.write(xfer_size.to_bytes(4, byteorder='little'))
+                    offset = img_length - remain
+
+                    # For SD/eMMC
+                    if xfer_size > remain:
+                        xfer_size = remain
+                        data = data[0: remain]
+
+                    if not same_data(pack_image.img_content(i, offset, xfer_size), data):
+                        print("Verify failed")
+                        return -1
+                    remain -= xfer_size
+                    bar.update(xfer_size)
+
+    dev_num = device_slot(dev)
+    print(f"device {dev_num} {image_cnt} images in {time.perf_counter() - begin:.2f}s, "
+          f"{dev.ready_wait:.2f}s waiting for command ACKs")
+    return 0
+
+
+def __group_pieces(pack_image, members, position, errors):
+    # Content of the runs of a pack v2 sparse image front to back from flash offset position, 0xFF between them.
+    # Problems are added to errors, the pieces stop short and the write command is padded out.
+    for j in members:
+        img_length, img_start, img_type = pack_image.img_attr(j)
+        for offset in range(position, img_start, PACK_BLOCK):
+            yield b'\xFF' * min(PACK_BLOCK, img_start - offset)
+        position = img_start + img_length
+        if pack_image.img_compress(j) == COMPRESS_NONE:
+            for data in pack_image.img_chunks(j, PACK_BLOCK):
+                yield data
+            if pack_image.img_check(j) is False:
+                errors.append("Pack CRC check failed")
+                return
+            continue
+        if pack_image.img_check(j) is False:
+            errors.append("Pack CRC check failed")
+            return
+        stream = StreamImage(pack_image.img_stored(j), STREAM_SEGMENT, pack_image.img_compress(j))
+        digest = hashlib.sha256()
+        try:
+            for offset, data in stream:
+                digest.update(data)
+                yield data
+        finally:
+            stream.close()
+        if stream.error is not None:
+            errors.append(f"Decompress failed: {stream.error}")
+            return
+        if digest.digest() != pack_image.img_sha256(j):
+            errors.append("Decompressed image SHA-256 mismatch")
+            return
+
+
+def __group_program(dev, media, pack_image, members, option, text) -> int:
+    # One write command from the block of the first run to the end of the last, xusb skips bad blocks
+    # within a command only and a run after a gap would land off its place.
+    nand_align, spinand_align, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block = dev.get_align()
+    img_length, start, img_type = pack_image.img_attr(members[0])
+    start -= start % (nand_align if media == DEV_NAND else spinand_align)
+    last_length, last_start, last_type = pack_image.img_attr(members[-1])
+    length = last_start + last_length - start
+    dev_num = device_slot(dev)
+
+    errors = []
+    image = _SequentialImage(__group_pieces(pack_image, members, start, errors), length)
+    with _Progress(dev_num, "Programming", length, desc=f"device {dev_num} {text}",
+                   bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+        if __write_runs(dev, media, start, [(0, length)], img_type, image.chunks, length, bar.update) != 0:
+            return -1
+    if len(errors) == 0 and image.exact() is False:
+        errors.append(f"Sparse image is not {length} bytes")
+    if len(errors) > 0:
+        print(errors[0])
+        return -1
+    if option == OPT_VERIFY:
+        image = _SequentialImage(__group_pieces(pack_image, members, start, errors), length)
+        with _Progress(dev_num, "Verifying", length, desc=f"device {dev_num} Verifying",
+                       bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+            if __img_verify(dev, media, start, image, [(0, length)], bar.update) != 0:
+                return -1
     return 0
 
 
@@ -941,23 +1459,19 @@ def do_pack_program(media, pack_file_name, option=OPT_NONE) -> int:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
-    if len(devices) == 0:
+    if len(devices) == 0 and station is None:
         print("Device not found")
         sys.exit(2)
 
-    pack_image = UnpackImage(pack_file_name, option)
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__pack_program, dev, media, pack_image, option) for dev in devices]
-    success = 0
-    failed = 0
-    for future in as_completed(futures):
-        if future.result() == 0:
-            success += 1
-        else:
-            failed += 1
+    if option == OPT_BGCRC:
+        pack_image = UnpackImage(pack_file_name, 0, background=True)
+    else:
+        pack_image = UnpackImage(pack_file_name, option)
+    success, failed = __run_devices(devices, device_phases, __pack_program, media, pack_image, option)
+    __slot_summary()
 
     print(f"Successfully programmed {success} device(s)")
     if failed > 0:
@@ -967,7 +1481,8 @@ def do_pack_program(media, pack_file_name, option=OPT_NONE) -> int:
     return 0
 
 
-def __img_program(dev, media, start, img_data, option) -> int:
+def __img_program(dev, media, start, img_data, option, runs=None) -> int:
+    # Workers share one image, a memoryview or SparseImage, and slice it instead of copying chunks
 
     nand_align, spinand_align, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block = dev.get_align()
 
@@ -984,61 +1499,49 @@ def __img_program(dev, media, start, img_data, option) -> int:
 
     img_length = len(img_data)
     #print(f"image length is {img_length}")
-    cmd = start.to_bytes(8, byteorder='little')
-    cmd += img_length.to_bytes(8, byteorder='little')
-    cmd += ACT_WRITE.to_bytes(4, byteorder='little')
-    if option == OPT_EXECUTE:
-        cmd += option.to_bytes(4, byteorder='little')
-    else:
-        cmd += b'\x00' * 4
+    chunks = lambda size, begin, end: split_chunks(img_data, size, begin, end)
+    # Ranges from a block map are all that is written and verified, unmapped blocks are don't care
+    verify_runs = [(0, img_length)] if runs is None else runs
+    if runs is None and skip_erased is True and media in (DEV_NAND, DEV_SPINAND):
+        runs = __data_runs(img_data, nand_align if media == DEV_NAND else spinand_align)
+    elif runs is None:
+        runs = [(0, img_length)]
 
-    dev.set_media(media)
-    dev.write(cmd)
-    ack = dev.read(4)
-    if int.from_bytes(ack, byteorder="little") != ACK:
-        print("Receive ACK error")
-        return -1
-
-    dev_num = bus_address(dev.get_bus(),dev.get_address())
-    if  dev_num == -1:
-        reset_bus_address(dev.get_bus(),dev.get_address())
-        dev_num = 0
+    dev_num = device_slot(dev)
 
     # Set ascii=True is for Windows cmd terminal, position > 0 doesn't work as expected in cmd though...
     text = f"device {dev_num} Programming"
-    bar = tqdm(total=img_length, position=dev_num, ascii=True, desc=text, bar_format='{l_bar}{bar:10}{bar:-10b}')
-    for offset in range(0, img_length, TRANSFER_SIZE):
-        xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < img_length else img_length - offset
-        dev.write(img_data[offset: offset + xfer_size])
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") != xfer_size:
-            print("Ack size error")
+    with _Progress(dev_num, "Programming", img_length, desc=text, bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+        if __write_runs(dev, media, start, runs, option if option == OPT_EXECUTE else 0,
+                        chunks, img_length, bar.update) != 0:
             return -1
-        bar.update(xfer_size)
-    dev.read(4)
-    bar.close()
     if option == OPT_VERIFY:
+        dev_num = device_slot(dev)
+
+        text = f"device {dev_num} Verifying"
+        with _Progress(dev_num, "Verifying", sum(length for offset, length in verify_runs), desc=text,
+                       bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+            if __img_verify(dev, media, start, img_data, verify_runs, bar.update) != 0:
+                return -1
+        print("Verify pass")
+    return 0
+
+
+def __img_verify(dev, media, start, img_data, runs, progress) -> int:
+    # Read back each run and compare it with the image
+    for run_offset, run_length in runs:
         dev.set_media(media)
-        cmd = start.to_bytes(8, byteorder='little')
-        cmd += img_length.to_bytes(8, byteorder='little')
+        cmd = (start + run_offset).to_bytes(8, byteorder='little')
+        cmd += run_length.to_bytes(8, byteorder='little')
         cmd += ACT_READ.to_bytes(4, byteorder='little')
         cmd += b'\x00' * 4
 
-        dev.write(cmd)
-        ack = dev.read(4)
+        ack = dev.command(cmd)
         if int.from_bytes(ack, byteorder="little") != ACK:
             print("Receive ACK error")
             return -1
 
-        remain = img_length
-        
-        dev_num = bus_address(dev.get_bus(),dev.get_address())
-        if dev_num == -1:
-            reset_bus_address(dev.get_bus(),dev.get_address())
-            dev_num = 0
-                
-        text = f"device {dev_num} Verifying"
-        bar = tqdm(total=img_length, position=dev_num, ascii=True, desc=text, bar_format='{l_bar}{bar:10}{bar:-10b}')
+        remain = run_length
         while remain > 0:
             ack = dev.read(4)
             # Get the transfer length of next read
@@ -1046,52 +1549,229 @@ def __img_program(dev, media, start, img_data, option) -> int:
 
             data = dev.read(xfer_size)
             dev.write(xfer_size.to_bytes(4, byteorder='little'))  # ack
-            offset = img_length - remain
+            offset = run_offset + run_length - remain
 
             # For SD/eMMC
             if xfer_size > remain:
                 xfer_size = remain
                 data = data[0: remain]
 
-            if data != bytearray(img_data[offset: offset + xfer_size]):
+            if not same_data(img_data[offset: offset + xfer_size], data):
                 print("Verify failed")
                 return -1
             remain -= xfer_size
-            bar.update(xfer_size)
+            progress(xfer_size)
+    return 0
+
+
+class _SequentialImage:
+    # Image read front to back from pieces of any size, like decompressed segments. Serves the chunks of
+    # __write_image and the slices of __img_verify in order. Once the pieces run out it pads with 0xFF,
+    # so a write command still gets every byte it was given the length of.
+
+    def __init__(self, pieces, length):
+        self.pieces = iter(pieces)
+        self.length = length
+        self.piece = memoryview(b'')
+        self.short = False
+
+    def read(self, size) -> memoryview:
+        if len(self.piece) >= size:
+            data = self.piece[0: size]
+            self.piece = self.piece[size:]
+            return data
+        parts = [self.piece]
+        got = len(self.piece)
+        while got < size:
+            piece = next(self.pieces, None)
+            if piece is None:
+                self.short = True
+                piece = b'\xFF' * (size - got)
+            piece = memoryview(piece)
+            parts.append(piece[0: size - got])
+            self.piece = piece[size - got:]
+            got += len(parts[-1])
+        return memoryview(b''.join(parts))
+
+    def chunks(self, size, begin, end):
+        for offset in range(begin, end, size):
+            yield self.read(min(size, end - offset))
+
+    def __getitem__(self, index) -> memoryview:
+        start, end, step = index.indices(self.length)
+        return self.read(end - start)
+
+    def exact(self) -> bool:
+        # True if the pieces held exactly length bytes, call once they have all been read
+        return self.short is False and len(self.piece) == 0 and next(self.pieces, None) is None
+
+
+def __stream_program(dev, media, start, source, option, cmd_option, text, compress=None, expect_sha256=None,
+                     length=None) -> int:
+    # Program a gzip/xz/zstd file name or pack view while a thread decompresses ahead of the USB writer.
+    # Each device decompresses on its own so a slow or failed device never holds back the others.
+    nand_align, spinand_align, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block = dev.get_align()
+
+    if (media == DEV_NAND and nand_align == 0) or \
+       (media == DEV_SPINAND and spinand_align == 0):
+        print("Unable to get block size")
+        return -1
+
+    if (media == DEV_NAND and start % nand_align != 0) or\
+       (media == DEV_SPINAND and start % spinand_align != 0) or \
+       (media == DEV_SPINOR and start % SPINOR_ALIGN != 0):
+        print("Starting address must be block aligned")
+        return -1
+
+    dev_num = device_slot(dev)
+
+    if length is None and (media in (DEV_NAND, DEV_SPINAND) or cmd_option != 0):
+        length = __stream_length(source, compress)
+    if length is None:
+        # Size not known up front, each segment is programmed and verified with its own commands.
+        # Only for plain data on eMMC/SD and SPI NOR, where a command does not skip bad blocks.
+        stream = StreamImage(source, STREAM_SEGMENT, compress)
+        digest = hashlib.sha256()
+        bar = _Progress(dev_num, "Programming", None, desc=f"device {dev_num} {text}", unit_scale=True,
+                        bar_format='{desc}: {n_fmt} {rate_fmt}')
+        try:
+            for offset, data in stream:
+                digest.update(data)
+                chunks = lambda size, begin, end, segment=data: split_chunks(segment, size, begin, end)
+                if __write_runs(dev, media, start + offset, [(0, len(data))], cmd_option, chunks, len(data),
+                                bar.update) != 0:
+                    return -1
+                if option == OPT_VERIFY and __img_verify(dev, media, start + offset, data, [(0, len(data))],
+                                                         lambda size: None) != 0:
+                    return -1
+        finally:
+            stream.close()
+            bar.close()
+    else:
+        # One write command for the whole image, fed segment by segment as they are decompressed. NAND and
+        # SPI NAND need it, xusb skips bad blocks within a command only. So do boot images and images to execute.
+        stream = StreamImage(source, STREAM_SEGMENT, compress)
+        digest = hashlib.sha256()
+
+        def pieces():
+            for offset, data in stream:
+                digest.update(data)
+                yield data
+
+        image = _SequentialImage(pieces(), length)
+        with _Progress(dev_num, "Programming", length, desc=f"device {dev_num} {text}",
+                       bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+            try:
+                if __write_runs(dev, media, start, [(0, length)], cmd_option, image.chunks, length, bar.update) != 0:
+                    return -1
+                exact = image.exact()
+            finally:
+                stream.close()
+        if stream.error is None and exact is False:
+            print(f"Decompressed image is not {length} bytes")
+            return -1
+    if stream.error is not None:
+        print(f"Decompress failed: {stream.error}")
+        return -1
+    # Pack v2 records the hash of the decompressed image
+    if expect_sha256 is not None and digest.digest() != expect_sha256:
+        print("Decompressed image SHA-256 mismatch")
+        return -1
+    if option == OPT_VERIFY and length is not None:
+        # Decompress again and compare with one read of the whole image
+        stream = StreamImage(source, STREAM_SEGMENT, compress)
+        image = _SequentialImage((data for offset, data in stream), length)
+        with _Progress(dev_num, "Verifying", length, desc=f"device {dev_num} Verifying",
+                       bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+            try:
+                if __img_verify(dev, media, start, image, [(0, length)], bar.update) != 0:
+                    return -1
+            finally:
+                stream.close()
+    if option == OPT_VERIFY:
         print("Verify pass")
-        bar.close()
     return 0
 
 
+def __stream_length(source, compress=None) -> int:
+    # Decompress once to learn the image size, for images that have to go in one write command
+    print("Measuring decompressed image ...")
+    stream = StreamImage(source, STREAM_SEGMENT, compress)
+    try:
+        length = sum(len(data) for offset, data in stream)
+    finally:
+        stream.close()
+    if stream.error is not None:
+        print(f"Decompress failed: {stream.error}")
+        sys.exit(1)
+    return length
+
+
 def do_img_program(media, start, image_file_name, option=OPT_NONE) -> int:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
-    if len(devices) == 0:
+    if len(devices) == 0 and station is None:
         print("Device not found")
         sys.exit(2)
+    if decompress is True:
+        if file_compress_type(image_file_name) == COMPRESS_NONE:
+            print(f"{image_file_name} is not a gzip, xz or zstd image")
+            sys.exit(0)
+        # All devices share one measuring pass, then each streams the image into one write command
+        length = None
+        if media in (DEV_NAND, DEV_SPINAND) or option == OPT_EXECUTE:
+            length = __stream_length(image_file_name)
+        return __program_devices(devices, __stream_program, media, start, image_file_name, option,
+                                 option if option == OPT_EXECUTE else 0, "Programming", None, None, length)
+
+    # Sparse images are expanded chunk by chunk as they are sent, DONT_CARE chunks are not written.
+    # NAND and SPI NAND get the whole image in one write command with DONT_CARE as 0xFF instead, xusb
+    # skips bad blocks within a command only and a run after a gap would land off its place.
+    if is_sparse(image_file_name):
+        if media in (DEV_NAND, DEV_SPINAND):
+            img_data = SparseImage(image_file_name, 0xFF)
+            print(f"Sparse image, {len(img_data)} bytes to write with DONT_CARE chunks erased")
+            return __program_devices(devices, __img_program, media, start, img_data, option)
+        img_data = SparseImage(image_file_name)
+        runs = img_data.runs()
+        print(f"Sparse image, {sum(length for offset, length in runs)} of {len(img_data)} bytes to write")
+        return __program_devices(devices, __img_program, media, start, img_data, option, runs)
+
+    # eMMC/SD disk images with a .bmap sidecar only get their mapped ranges written
+    bmap_file_name = find_bmap(image_file_name) if media == DEV_SD_EMMC else ''
+    runs = None
     try:
         with open(image_file_name, "rb") as image_file:
-            print("Loading Image...")
-            img_data = image_file.read()
-            print("done")
+            if bmap_file_name != '':
+                # Map the image, unmapped ranges are never read
+                img_data = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                print("Loading Image...")
+                img_data = image_file.read()
+                print("done")
 
-    except (IOError, OSError) as err:
+    except (IOError, OSError, ValueError) as err:
         print(f"Open {image_file_name} failed")
         sys.exit(err)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__img_program, dev, media, start, img_data, option) for dev in devices]
-    success = 0
-    failed = 0
-    for future in as_completed(futures):
-        if future.result() == 0:
-            success += 1
-        else:
-            failed += 1
+    if bmap_file_name != '':
+        block_map = BlockMap(bmap_file_name)
+        print(f"Checking image against {bmap_file_name} ...")
+        if not block_map.check(memoryview(img_data)):
+            sys.exit(1)
+        runs = block_map.runs()
+        print(f"{block_map.mapped_size()} of {block_map.image_size} bytes mapped")
+
+    return __program_devices(devices, __img_program, media, start, memoryview(img_data), option, runs)
+
+
+def __program_devices(devices, program, *args) -> int:
+    success, failed = __run_devices(devices, device_phases, program, *args)
+    __slot_summary()
 
     print(f"Successfully programmed {success} device(s)")
     if failed > 0:
@@ -1103,7 +1783,7 @@ def do_img_program(media, start, image_file_name, option=OPT_NONE) -> int:
 def do_img_read(media, start, out_file_name, length=0x1, option=OPT_NONE) -> None:
     # only support read from 1 device
     # devices = XUsbComList(attach_all=False).get_dev()
-    _XUsbComList = XUsbComList(attach_all=False)
+    _XUsbComList = __open_devices(False)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
@@ -1146,7 +1826,6 @@ def do_img_read(media, start, out_file_name, length=0x1, option=OPT_NONE) -> Non
             length = emmc_block * 512;
         print(length)
 
-    bar = tqdm(total=length, ascii=True, bar_format='{l_bar}{bar:10}{bar:-10b}')
     data = b''
     remain = length
 
@@ -1156,18 +1835,18 @@ def do_img_read(media, start, out_file_name, length=0x1, option=OPT_NONE) -> Non
         print(f"Open {out_file_name} failed")
         sys.exit(err)
 
-    while remain > 0:
-        ack = dev.read(4)
-        # Get the transfer length of next read
-        xfer_size = int.from_bytes(ack, byteorder="little")
+    with _Progress(device_slot(dev), "Reading", length, bar_format='{l_bar}{bar:10}{bar:-10b}') as bar:
+        while remain > 0:
+            ack = dev.read(4)
+            # Get the transfer length of next read
+            xfer_size = int.from_bytes(ack, byteorder="little")
 
-        data = dev.read(xfer_size)
-        dev.write(xfer_size.to_bytes(4, byteorder='little'))    # ack
-        out_file.write(data)
-        remain -= xfer_size
-        bar.update(xfer_size)
+            data = dev.read(xfer_size)
+            dev.write(xfer_size.to_bytes(4, byteorder='little'))    # ack
+            out_file.write(data)
+            remain -= xfer_size
+            bar.update(xfer_size)
 
-    bar.close()
     out_file.close()
 
 
@@ -1196,23 +1875,93 @@ def __attach(dev, ini_data, xusb_data, in_sram) -> int:
     else:
         out += b'\x00\x00\x00\x87'  # Execute address is 0x87000000
     dev.write(out)
-    for offset in range(0, xusb_len, TRANSFER_SIZE):
-        xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < xusb_len else xusb_len - offset
-
-        dev.write(xusb_data[offset: offset + xfer_size])
-        if offset + xfer_size != xusb_len:  # Ignore the ack of last packet
-            ack = dev.read(4)
-            if int.from_bytes(ack, byteorder="little") != xfer_size:
-                _ack = int.from_bytes(ack, byteorder="little")
-                print(f"Ack size error {_ack} {xfer_size}")
-                return -1
+    # Ignore the ack of last packet
+    if dev.write_chunks(split_chunks(xusb_data, TRANSFER_SIZE), xfer_window, ack_last=False) != 0:
+        return -1
 
     return 0
 
 
+def __info_data(option) -> bytearray:
+    # get_info request, media settings come from info.json with -o setinfo
+    data = bytearray(84)
+    # default SOM LED is PJ15
+    data[76] = 9
+    data[77] = 15
+    data[78] = 0
+    data[79] = 1
+    # assign option file to set media info
+    if option == OPT_SETINFO:
+        try:
+            with open("info.json", "r") as json_file:
+                try:
+                    d = json.load(json_file)
+                except json.decoder.JSONDecodeError as err:
+                    print(f"{json_file} parsing error")
+                    sys.exit(err)
+        except (IOError, OSError) as err:
+            print("Open info.json failed")
+            sys.exit(err)
+        # now generate info from info.json
+        for key in d.keys():
+            if key == 'led':
+                for sub_key in d['led'].keys():
+                    if sub_key == 'port':
+                        data[76:77] = int(d['led']['port'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'bit':
+                        data[77:78] = int(d['led']['bit'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'on':
+                        data[78:79] = int(d['led']['on'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'off':
+                        data[79:80] = int(d['led']['off'], 0).to_bytes(1, byteorder="little")
+            if key == 'spinand':
+                data[48] = 1
+                for sub_key in d['spinand'].keys():
+                    if sub_key == 'pagesize':
+                        data[56:58] = int(d['spinand']['pagesize'], 0).to_bytes(2, byteorder="little")
+                    elif sub_key == 'sparearea':
+                        data[58:60] = int(d['spinand']['sparearea'], 0).to_bytes(2, byteorder="little")
+                    elif sub_key == 'quadread':
+                        data[60:61] = int(d['spinand']['quadread'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'readsts':
+                        data[61:62] = int(d['spinand']['readsts'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'writests':
+                        data[62:63] = int(d['spinand']['writests'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'stsvalue':
+                        data[63:64] = int(d['spinand']['stsvalue'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'dummy':
+                        data[64:68] = int(d['spinand']['dummy'], 0).to_bytes(4, byteorder="little")
+                    elif sub_key == 'blkcnt':
+                        data[68:72] = int(d['spinand']['blkcnt'], 0).to_bytes(4, byteorder="little")
+                    elif sub_key == 'pageperblk':
+                        data[72:76] = int(d['spinand']['pageperblk'], 0).to_bytes(4, byteorder="little")
+            elif key == 'spinor':
+                data[28] = 1
+                for sub_key in d['spinor'].keys():
+                    if sub_key == 'quadread':
+                        data[32:33] = int(d['spinor']['quadread'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'readsts':
+                        data[33:34] = int(d['spinor']['readsts'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'writests':
+                        data[34:35] = int(d['spinor']['writests'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'stsvalue':
+                        data[35:36] = int(d['spinor']['stsvalue'], 0).to_bytes(1, byteorder="little")
+                    elif sub_key == 'dummy':
+                        data[36:40] = int(d['spinor']['dummy'], 0).to_bytes(4, byteorder="little")
+            elif key == 'nand':
+                data[20] = 1
+                for sub_key in d['nand'].keys():
+                    if sub_key == 'blkcnt':
+                        data[8:12] = int(d['nand']['blkcnt'], 0).to_bytes(4, byteorder="little")
+                    elif sub_key == 'pageperblk':
+                        data[0:4] = int(d['nand']['pageperblk'], 0).to_bytes(4, byteorder="little")
+    return data
+
+
 def __get_info(dev, data, pdid) -> int:
     try:
-        info = dev.get_info(data)
+        # Devices found back after loading xusb have already answered get_info
+        info = dev.info if len(dev.info) != 0 else dev.get_info(data)
     except usb.core.USBError as err:
         sys.exit(err)
 
@@ -1291,13 +2040,8 @@ def __do_nuwriter(dev, media, start, img_data, xusb_data, option) -> int:
         print("Receive ACK error")
         return -1
 
-    for offset in range(0, img_length, TRANSFER_SIZE):
-        xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < img_length else img_length - offset
-        dev.write(img_data[offset: offset + xfer_size])
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") != xfer_size:
-            print("Ack size error")
-            return -1
+    if dev.write_chunks(split_chunks(img_data, TRANSFER_SIZE), xfer_window) != 0:
+        return -1
     dev.read(4)
 
     xusb_length = len(xusb_data)
@@ -1314,13 +2058,8 @@ def __do_nuwriter(dev, media, start, img_data, xusb_data, option) -> int:
         print("Receive ACK error")
         return -1
 
-    for offset in range(0, xusb_length, TRANSFER_SIZE):
-        xfer_size = TRANSFER_SIZE if offset + TRANSFER_SIZE < xusb_length else xusb_length - offset
-        dev.write(xusb_data[offset: offset + xfer_size])
-        ack = dev.read(4)
-        if int.from_bytes(ack, byteorder="little") != xfer_size:
-            print("Ack size error")
-            return -1
+    if dev.write_chunks(split_chunks(xusb_data, TRANSFER_SIZE), xfer_window) != 0:
+        return -1
     dev.read(4)
 
     return 0
@@ -1331,7 +2070,7 @@ def do_nuwriter(media, start, image_file_name, option=OPT_NONE) -> None:
 
     print("load nuwriter")
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
@@ -1347,102 +2086,30 @@ def do_nuwriter(media, start, image_file_name, option=OPT_NONE) -> None:
 
     xusb_location = "missing"
     if os.path.exists("xusb.bin"):  # default use the xusb.bin in current directory
-        xusb_location = "xusb.bin"
-    if xusb_location == "missing":
-        #print("Cannot find xusb.bin")
-        print(f"{xusb_location} failed")
-        sys.exit(3)
-    try:
-        with open(xusb_location, "rb") as xusb_file:
-            xusb_data = xusb_file.read()
-    except (IOError, OSError) as err:
-        print("Open xusb.bin failed")
-        sys.exit(err)
-
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__do_nuwriter, dev, media, start, img_data, xusb_data, option) for dev in devices]
-
-    time.sleep(2)
-
-    # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComListNew = XUsbComList(attach_all=mp_mode)
-    devices = _XUsbComListNew.get_dev()
-
-    data = bytearray(84)
-    # default SOM LED is PJ15
-    data[76] = 9
-    data[77] = 15
-    data[78] = 0
-    data[79] = 1
-    # assign option file to set media info
-    if option == OPT_SETINFO:
-        try:
-            with open("info.json", "r") as json_file:
-                try:
-                    d = json.load(json_file)
-                except json.decoder.JSONDecodeError as err:
-                    print(f"{json_file} parsing error")
-                    sys.exit(err)
-        except (IOError, OSError) as err:
-            print("Open info.json failed")
-            sys.exit(err)
-        # now generate info from info.json
-        for key in d.keys():
-            if key == 'led':
-                for sub_key in d['led'].keys():
-                    if sub_key == 'port':
-                        data[76:77] = int(d['led']['port'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'bit':
-                        data[77:78] = int(d['led']['bit'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'on':
-                        data[78:79] = int(d['led']['on'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'off':
-                        data[79:80] = int(d['led']['off'], 0).to_bytes(1, byteorder="little")
-            if key == 'spinand':
-                data[48] = 1
-                for sub_key in d['spinand'].keys():
-                    if sub_key == 'pagesize':
-                        data[56:58] = int(d['spinand']['pagesize'], 0).to_bytes(2, byteorder="little")
-                    elif sub_key == 'sparearea':
-                        data[58:60] = int(d['spinand']['sparearea'], 0).to_bytes(2, byteorder="little")
-                    elif sub_key == 'quadread':
-                        data[60:61] = int(d['spinand']['quadread'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'readsts':
-                        data[61:62] = int(d['spinand']['readsts'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'writests':
-                        data[62:63] = int(d['spinand']['writests'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'stsvalue':
-                        data[63:64] = int(d['spinand']['stsvalue'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'dummy':
-                        data[64:68] = int(d['spinand']['dummy'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'blkcnt':
-                        data[68:72] = int(d['spinand']['blkcnt'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'pageperblk':
-                        data[72:76] = int(d['spinand']['pageperblk'], 0).to_bytes(4, byteorder="little")
-            elif key == 'spinor':
-                data[28] = 1
-                for sub_key in d['spinor'].keys():
-                    if sub_key == 'quadread':
-                        data[32:33] = int(d['spinor']['quadread'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'readsts':
-                        data[33:34] = int(d['spinor']['readsts'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'writests':
-                        data[34:35] = int(d['spinor']['writests'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'stsvalue':
-                        data[35:36] = int(d['spinor']['stsvalue'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'dummy':
-                        data[36:40] = int(d['spinor']['dummy'], 0).to_bytes(4, byteorder="little")
-            elif key == 'nand':
-                data[20] = 1
-                for sub_key in d['nand'].keys():
-                    if sub_key == 'blkcnt':
-                        data[8:12] = int(d['nand']['blkcnt'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'pageperblk':
-                        data[0:4] = int(d['nand']['pageperblk'], 0).to_bytes(4, byteorder="little")
+        xusb_location = "xusb.bin"
+    if xusb_location == "missing":
+        #print("Cannot find xusb.bin")
+        print(f"{xusb_location} failed")
+        sys.exit(3)
+    try:
+        with open(xusb_location, "rb") as xusb_file:
+            xusb_data = xusb_file.read()
+    except (IOError, OSError) as err:
+        print("Open xusb.bin failed")
+        sys.exit(err)
+
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
+        futures = [executor.submit(__do_nuwriter, dev, media, start, img_data, xusb_data, option) for dev in devices]
+
+    data = __info_data(option)
+    # Wait for the devices to re-enumerate running xusb, get_info tells when one is ready
+    _XUsbComListNew = XUsbComList(attach_all=mp_mode, previous=devices, data=data)
+    devices = _XUsbComListNew.get_dev()
+    __keep_devices(_XUsbComListNew)
     if len(devices) == 0:
         print("Device not found")
         sys.exit(2)
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
         futures = [executor.submit(__get_info, dev, data, 0) for dev in devices]
 
     success = 0
@@ -1453,6 +2120,7 @@ def do_nuwriter(media, start, image_file_name, option=OPT_NONE) -> None:
         else:
             failed += 1
 
+    XUsbCom.set_xusb(devices)
     print(f"Successfully get info from {success} device(s)")
 
 
@@ -1495,9 +2163,7 @@ def check_filename(mapping, filename):
         #print(f"pdid = {pdid}")
         return pdid
 
-def do_attach(ini_file_name, option=OPT_NONE) -> int:
-    global mp_mode
-
+def __attach_files(ini_file_name) -> (bytes, bytes, int, int):
     init_location = "missing"
     if os.path.exists(ini_file_name):  # default use the init file in current directory
         init_location = ini_file_name
@@ -1512,6 +2178,7 @@ def do_attach(ini_file_name, option=OPT_NONE) -> int:
     if init_location == "missing":
         print(f"Cannot find {ini_file_name}")
         sys.exit(3)
+    pdid = 0    # No PDID check without a mapping file
     try:
         if os.path.isdir("ddrimg"):
             pdid_map = load_mapping("ddrimg\\mapping.txt")
@@ -1554,131 +2221,107 @@ def do_attach(ini_file_name, option=OPT_NONE) -> int:
         print("Open xusb.bin failed")
         sys.exit(err)
 
-    # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
-    devices = _XUsbComList.get_dev()
+    return ini_data, xusb_data, in_sram, pdid
 
-    if len(devices) == 0:
-        print("Device not found")
-        sys.exit(2)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__attach, dev, ini_data, xusb_data, in_sram) for dev in devices]
-    success = 0
-    failed = 0
-    for future in as_completed(futures, timeout=2):
-        if future.result() == 0:
-            success += 1
+# Attach as phases of each device's pipeline, see __run_devices(). A device goes on to get_info and
+# whatever comes next as soon as it is back running xusb, it does not wait for the slowest one.
+def __attach_phases(ini_file_name, option) -> list:
+    global mp_mode
+    global attached_devices
+
+    ini_data, xusb_data, in_sram, pdid = __attach_files(ini_file_name)
+    data = __info_data(option)
+    attached = XUsbComList(previous=[])
+    attached_lock = threading.Lock()
+    attached_devices = attached
+
+    def attach(dev):
+        # Devices left running xusb by the last attach go straight to the info phase if they answer get_info
+        if in_sram == 0 and dev.is_xusb() and dev.probe_info(data):
+            print("Device already running xusb")
+            return dev
+        return dev if __attach(dev, ini_data, xusb_data, in_sram) == 0 else None
+
+    def enumerate_xusb(dev):
+        # Wait for the device to come back running xusb, get_info tells when it is ready
+        if len(dev.info) == 0:
+            found = XUsbComList(attach_all=mp_mode, previous=[dev], data=data)
+            if len(found.get_dev()) == 0:
+                return None
+            dev = found.get_dev()[0]
+            with attached_lock:
+                attached.take(found)
+                __keep_devices(attached)
         else:
-            failed += 1
+            with attached_lock:
+                attached.get_dev().append(dev)
+                __keep_devices(attached)
+        return dev
 
-    #print(f"Successfully attached {success} device(s)")
-    if failed > 0:
-        print(f"Failed to attach {failed} device(s)")
-        sys.exit(1)
-        
-    if success == 0:
-        return 1
+    def get_info(dev):
+        if __get_info(dev, data, pdid) != 0:
+            return None
+        XUsbCom.set_xusb([dev])
+        return dev
 
     if in_sram == 1:
+        return [("Attach", attach)]
+    return [("Attach", attach), ("Re-enumerate", enumerate_xusb), ("Get info", get_info)]
+
+
+# Erase the whole media as a phase of each device's pipeline
+def __erase_phase(media) -> tuple:
+    def erase(dev):
+        return dev if __img_erase(dev, media, 0, 0, OPT_NONE) == 0 else None
+    return "Erase", erase
+
+
+def do_attach(ini_file_name, option=OPT_NONE) -> int:
+    global mp_mode
+
+    if session is not None and session["attached"] is True:
+        print("Devices already attached")
         return 0
 
-    time.sleep(2)
+    phases = __attach_phases(ini_file_name, option)
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComListNew = XUsbComList(attach_all=mp_mode)
-    devices = _XUsbComListNew.get_dev()
+    _XUsbComList = __open_devices(mp_mode)
+    devices = _XUsbComList.get_dev()
 
-    data = bytearray(84)
-    # default SOM LED is PJ15
-    data[76] = 9
-    data[77] = 15
-    data[78] = 0
-    data[79] = 1
-    # assign option file to set media info
-    if option == OPT_SETINFO:
-        try:
-            with open("info.json", "r") as json_file:
-                try:
-                    d = json.load(json_file)
-                except json.decoder.JSONDecodeError as err:
-                    print(f"{json_file} parsing error")
-                    sys.exit(err)
-        except (IOError, OSError) as err:
-            print("Open info.json failed")
-            sys.exit(err)
-        # now generate info from info.json
-        for key in d.keys():
-            if key == 'led':
-                for sub_key in d['led'].keys():
-                    if sub_key == 'port':
-                        data[76:77] = int(d['led']['port'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'bit':
-                        data[77:78] = int(d['led']['bit'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'on':
-                        data[78:79] = int(d['led']['on'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'off':
-                        data[79:80] = int(d['led']['off'], 0).to_bytes(1, byteorder="little")
-            if key == 'spinand':
-                data[48] = 1
-                for sub_key in d['spinand'].keys():
-                    if sub_key == 'pagesize':
-                        data[56:58] = int(d['spinand']['pagesize'], 0).to_bytes(2, byteorder="little")
-                    elif sub_key == 'sparearea':
-                        data[58:60] = int(d['spinand']['sparearea'], 0).to_bytes(2, byteorder="little")
-                    elif sub_key == 'quadread':
-                        data[60:61] = int(d['spinand']['quadread'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'readsts':
-                        data[61:62] = int(d['spinand']['readsts'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'writests':
-                        data[62:63] = int(d['spinand']['writests'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'stsvalue':
-                        data[63:64] = int(d['spinand']['stsvalue'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'dummy':
-                        data[64:68] = int(d['spinand']['dummy'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'blkcnt':
-                        data[68:72] = int(d['spinand']['blkcnt'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'pageperblk':
-                        data[72:76] = int(d['spinand']['pageperblk'], 0).to_bytes(4, byteorder="little")
-            elif key == 'spinor':
-                data[28] = 1
-                for sub_key in d['spinor'].keys():
-                    if sub_key == 'quadread':
-                        data[32:33] = int(d['spinor']['quadread'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'readsts':
-                        data[33:34] = int(d['spinor']['readsts'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'writests':
-                        data[34:35] = int(d['spinor']['writests'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'stsvalue':
-                        data[35:36] = int(d['spinor']['stsvalue'], 0).to_bytes(1, byteorder="little")
-                    elif sub_key == 'dummy':
-                        data[36:40] = int(d['spinor']['dummy'], 0).to_bytes(4, byteorder="little")
-            elif key == 'nand':
-                data[20] = 1
-                for sub_key in d['nand'].keys():
-                    if sub_key == 'blkcnt':
-                        data[8:12] = int(d['nand']['blkcnt'], 0).to_bytes(4, byteorder="little")
-                    elif sub_key == 'pageperblk':
-                        data[0:4] = int(d['nand']['pageperblk'], 0).to_bytes(4, byteorder="little")
     if len(devices) == 0:
         print("Device not found")
         sys.exit(2)
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(__get_info, dev, data, pdid) for dev in devices]
 
-    success = 0
-    failed = 0
-    for future in as_completed(futures, timeout=2):
-        if future.result() == 0:
-            success += 1
-        else:
-            failed += 1
-            return 1
+    success, failed = __run_devices(devices, phases, lambda dev: 0)
+
+    #print(f"Successfully attached {success} device(s)")
+    if failed > 0:
+        print(f"Failed to attach {failed} device(s)")
+        sys.exit(1)
+
+    if "enc_ma35_nuwriter.bin" in ini_file_name:
+        if session is not None:
+            session["devices"] = None   # Boot ROM handles are gone once nuwriter runs
+        return 0
 
     print(f"Successfully get info from {success} device(s)")
     return 0
 
 
+def __link_output(out_dir, link) -> None:
+    # Point the pack/unpack symbolic folder at the latest output
+    try:
+        os.unlink(link)
+    except (IOError, OSError):
+        pass
+    try:
+        os.symlink(out_dir, link)
+    except (IOError, OSError):
+        print(f"Create symbolic folder {link} failed")
+
+
 def do_unpack(pack_file_name, nocrc32) -> None:
 
     now = datetime.now()
@@ -1692,23 +2335,76 @@ def do_unpack(pack_file_name, nocrc32) -> None:
 
     for i in range(image_cnt):
         img_length, _, _ = pack_image.img_attr(i)
+        digest = hashlib.sha256()
         try:
             with open(now.strftime("%m%d-%H%M%S%f") + "/img" + str(i) + ".bin", "wb") as img_file:
-                img_file.write(pack_image.img_content(i, 0, img_length))
+                if pack_image.img_sha256(i) is not None and pack_image.img_compress(i) != COMPRESS_NONE:
+                    # Pack v2 images are unpacked decompressed, as they would be programmed
+                    stream = StreamImage(pack_image.img_stored(i), compress=pack_image.img_compress(i))
+                    for offset, data in stream:
+                        img_file.write(data)
+                        digest.update(data)
+                    if stream.error is not None:
+                        print(f"Decompress image {i} failed: {stream.error}")
+                        sys.exit(0)
+                else:
+                    img_file.write(pack_image.img_content(i, 0, img_length))
+                    if pack_image.img_sha256(i) is not None:
+                        digest.update(pack_image.img_content(i, 0, img_length))
         except (IOError, OSError) as err:
             print("Create output image file failed")
             sys.exit(err)
-    try:
-        os.unlink("unpack")
-    except (IOError, OSError):
-        pass
-    try:
-        os.symlink(now.strftime("%m%d-%H%M%S%f"), "unpack")
-    except (IOError, OSError):
-        print("Create symbolic folder unpack failed")
+        if pack_image.img_sha256(i) is not None and digest.digest() != pack_image.img_sha256(i):
+            print(f"Image {i} SHA-256 check failed")
+            sys.exit(0)
+    __link_output(now.strftime("%m%d-%H%M%S%f"), "unpack")
     print("Unpack images to directory {} complete".format(now.strftime("%m%d-%H%M%S%f")))
 
 
+def __load_image(file_name, checksum) -> tuple:
+    with open(file_name, "rb") as img_file:
+        img_len = os.fstat(img_file.fileno()).st_size
+        if img_len > PREFETCH_LIMIT:
+            return img_len, None, None
+        data = img_file.read()
+    return len(data), data, crc32(data) if checksum else None
+
+
+# Yield (img, future) in configuration order while reading up to PREFETCH_WORKERS images and PREFETCH_BUDGET
+# bytes ahead. future.result() is (length, data, crc), data and crc are None if the image is too large to read ahead
+def __prefetch_images(images, checksum=False):
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        pending = collections.deque()
+        held = 0
+        for img in images:
+            try:
+                size = os.path.getsize(img["file"])
+            except (IOError, OSError):
+                size = 0    # __load_image raises the error for the writer to report
+            if size > PREFETCH_LIMIT:
+                size = 0
+            while pending and (len(pending) >= PREFETCH_WORKERS or held + size > PREFETCH_BUDGET):
+                held -= pending[0][2]
+                yield pending.popleft()[0:2]
+            pending.append((img, executor.submit(__load_image, img["file"], checksum), size))
+            held += size
+        while pending:
+            yield pending.popleft()[0:2]
+
+
+# Copy length bytes through buf so memory use does not depend on image size. Return bytes missing from src
+def __copy_file(src, dst, length, buf, checksum=None) -> int:
+    while length > 0:
+        size = src.readinto(buf[:min(length, len(buf))])
+        if size == 0:
+            break
+        dst.write(buf[:size])
+        if checksum is not None:
+            checksum.update(buf[:size])
+        length -= size
+    return length
+
+
 def do_stuff(cfg_file) -> None:
     now = datetime.now()
 
@@ -1730,38 +2426,172 @@ def do_stuff(cfg_file) -> None:
         sys.exit(err)
 
     offset = 0
-    out = bytearray()
+    holes = []
+    buf = memoryview(bytearray(PACK_BLOCK))
+    gap = memoryview(b'\xFF' * PACK_BLOCK)
 
     # Start stuffing image
-    for img in d["image"]:
+    for img, future in __prefetch_images(d["image"]):
         try:
-            with open(img["file"], "rb") as img_file:
-                data = img_file.read()
+            img_len, data = future.result()[:2]
+            if data is None:
+                img_file = open(img["file"], "rb")
         except (IOError, OSError) as err:
-            print(f"Open {img_file} failed")
+            print(f"Open {img['file']} failed")
+            pack_file.close()
             shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
             sys.exit(err)
         if int(img["offset"], 0) < offset:
             print(f"Please place the files in {cfg_file} based on the ascending offset")
             sys.exit(4)
         elif int(img["offset"], 0) > offset:
-            out += b'\xFF' * (int(img["offset"], 0) - offset)
-            offset = int(img["offset"], 0)
-        out += data
-        offset += len(data)
-    pack_file.write(out)
+            # Fill the gap from a reusable 0xFF buffer
+            holes.append((offset, int(img["offset"], 0) - offset))
+            while offset < int(img["offset"], 0):
+                size = min(PACK_BLOCK, int(img["offset"], 0) - offset)
+                pack_file.write(gap[:size])
+                offset += size
+        if data is not None:
+            pack_file.write(data)
+        else:
+            remain = __copy_file(img_file, pack_file, img_len, buf)
+            img_file.close()
+            if remain != 0:
+                print(f"{img['file']} changed size while stuffing")
+                pack_file.close()
+                shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
+                sys.exit(1)
+        offset += img_len
     pack_file.close()
-    try:
-        os.unlink("pack")
-    except (IOError, OSError):
-        pass
-    try:
-        os.symlink(now.strftime("%m%d-%H%M%S%f"), "pack")
-    except (IOError, OSError):
-        print("Create symbolic folder pack failed")
+
+    # Optional hole map, lists the 0xFF gaps so flashing tools could skip them
+    if d.get("holemap", False) is True:
+        try:
+            with open(now.strftime("%m%d-%H%M%S%f") + "/pack.map", "w") as map_file:
+                json.dump({"size": hex(offset),
+                           "holes": [{"offset": hex(start), "length": hex(length)} for start, length in holes]},
+                          map_file, indent=4)
+        except (IOError, OSError) as err:
+            print("Create hole map failed")
+            sys.exit(err)
+    __link_output(now.strftime("%m%d-%H%M%S%f"), "pack")
     print("Generate pack file in directory {} complete".format(now.strftime("%m%d-%H%M%S%f")))
 
 
+def __pack_entry(pack_file, checksum, img_len, img_start, img_type) -> None:
+    hdr = img_len.to_bytes(8, byteorder="little")
+    hdr += img_start.to_bytes(8, byteorder="little")
+    hdr += img_type.to_bytes(4, byteorder="little")
+    hdr += b'\xFF' * 4
+    pack_file.write(hdr)
+    checksum.update(hdr)
+
+
+def __pack_pad(pack_file, checksum, img_len) -> None:
+    # Always put image start @ 16 byte boundary
+    pad = 16 - (img_len + 8) & 0xF
+    if pad != 16:
+        pack_file.write(b'\xFF' * pad)
+        checksum.update(b'\xFF' * pad)
+
+
+def __pack_align(pack_file) -> None:
+    if pack_file.tell() % 16 != 0:
+        pack_file.write(b'\xFF' * (16 - pack_file.tell() % 16))
+
+
+def __pack_blocks(source, buf):
+    # Raw image data of a pack v2 entry, a file or a (SparseImage, offset, length) run
+    if isinstance(source, tuple):
+        image, offset, length = source
+        yield from split_chunks(image, PACK_BLOCK, offset, offset + length)
+        return
+    with open(source, "rb") as img_file:
+        while True:
+            size = img_file.readinto(buf)
+            if size == 0:
+                break
+            yield buf[:size]
+
+
+def __pack_v2(pack_file, images, sparse, compressed) -> None:
+    # Gather every entry first, the TOC goes in front of the data. Entry is
+    # (source, flash offset, type, compression, source is already compressed, sparse group)
+    entries = []
+    for i, img in enumerate(images):
+        img_start = int(img["offset"], 0)
+        if i in compressed:
+            entries.append((img["file"], img_start, img["type"], compressed[i], True, NO_GROUP))
+        elif i in sparse:
+            # The runs are tied together so NAND can get them back in one write command
+            group = len(entries)
+            for run_offset, run_length in sparse[i].runs():
+                entries.append(((sparse[i], run_offset, run_length), img_start + run_offset, img["type"],
+                                PACK_COMPRESS[img.get("compress", "none")], False, group))
+        else:
+            entries.append((img["file"], img_start, img["type"], PACK_COMPRESS[img.get("compress", "none")], False,
+                            NO_GROUP))
+
+    toc_end = 16 + len(entries) * PACK_V2_ENTRY
+    pack_file.write(PACK_V2_MARKER + b'\xFF' * (toc_end - 4))
+    toc = bytearray()
+    buf = memoryview(bytearray(PACK_BLOCK))
+    for source, img_start, img_type, img_compress, stored_as_is, group in entries:
+        __pack_align(pack_file)
+        data_offset = pack_file.tell()
+        digest = hashlib.sha256()
+        crcs = ChunkCrc32(PACK_CRC_CHUNK)
+        img_len = 0
+        if stored_as_is is True:
+            for data in __pack_blocks(source, buf):
+                pack_file.write(data)
+                crcs.update(data)
+            # Length and hash are of what gets programmed, decompress once to get them
+            stream = StreamImage(source, compress=img_compress)
+            for offset, data in stream:
+                digest.update(data)
+                img_len += len(data)
+            if stream.error is not None:
+                raise ValueError(f"{source} decompress failed: {stream.error}")
+        else:
+            compress_obj = compressor(img_compress) if img_compress != COMPRESS_NONE else None
+            for data in __pack_blocks(source, buf):
+                digest.update(data)
+                img_len += len(data)
+                if compress_obj is not None:
+                    data = compress_obj.compress(data)
+                pack_file.write(data)
+                crcs.update(data)
+            if compress_obj is not None:
+                data = compress_obj.flush()
+                pack_file.write(data)
+                crcs.update(data)
+        stored_len = pack_file.tell() - data_offset
+
+        __pack_align(pack_file)
+        table_offset = pack_file.tell()
+        table = b''.join(crc.to_bytes(4, byteorder="little") for crc in crcs.get())
+        pack_file.write(table)
+
+        toc += img_len.to_bytes(8, byteorder="little")
+        toc += img_start.to_bytes(8, byteorder="little")
+        toc += img_type.to_bytes(4, byteorder="little")
+        toc += img_compress.to_bytes(4, byteorder="little")
+        toc += data_offset.to_bytes(8, byteorder="little")
+        toc += stored_len.to_bytes(8, byteorder="little")
+        toc += table_offset.to_bytes(8, byteorder="little")
+        toc += crc32(table).to_bytes(4, byteorder="little")
+        toc += group.to_bytes(4, byteorder="little")
+        toc += digest.digest()
+        if img_compress != COMPRESS_NONE:
+            print(f"Image {len(toc) // PACK_V2_ENTRY - 1}: {img_len} bytes stored in {stored_len}")
+
+    # CRC covers image count, CRC chunk size and the TOC
+    header = len(entries).to_bytes(4, byteorder="little") + PACK_CRC_CHUNK.to_bytes(4, byteorder="little") + toc
+    pack_file.seek(4)
+    pack_file.write(crc32(header).to_bytes(4, byteorder="little") + header)
+
+
 def do_pack(cfg_file) -> None:
     now = datetime.now()
 
@@ -1776,60 +2606,114 @@ def do_pack(cfg_file) -> None:
         print(f"Open {cfg_file} failed")
         sys.exit(err)
 
+    # "version": 2 selects pack v2, only it can compress images while packing them
+    version = d.get("version", 1)
+    if version not in (1, 2):
+        print(f"Unsupported pack version {version}")
+        sys.exit(0)
+    for img in d["image"]:
+        if img.get("compress", "none") not in PACK_COMPRESS:
+            print(f"Unknown compress {img['compress']} for {img['file']}, use {', '.join(PACK_COMPRESS)}")
+            sys.exit(0)
+        if version == 1 and img.get("compress", "none") != "none":
+            print(f"Compressing {img['file']} needs \"version\": 2")
+            sys.exit(0)
+        # A v1 pack has no field old NuWriter versions know for compressed data, they would program it raw
+        if version == 1 and img.get("compressed", False) is True:
+            print(f"Compressed image {img['file']} needs \"version\": 2")
+            sys.exit(0)
+
+    # Sparse images become one pack v2 entry per run, walk their chunk headers now to know the image count.
+    # A v1 pack has no way to tie runs together for NAND, so it stores one entry with DONT_CARE as 0xFF.
+    # Images marked "compressed" are stored as is and decompressed while they are programmed.
+    sparse = {}
+    compress = {}
+    for i, img in enumerate(d["image"]):
+        if img.get("compressed", False) is True:
+            compress[i] = file_compress_type(img["file"])
+            if compress[i] == COMPRESS_NONE:
+                print(f"{img['file']} is not a gzip, xz or zstd image")
+                sys.exit(0)
+        elif is_sparse(img["file"]):
+            sparse[i] = SparseImage(img["file"], 0xFF)
+    img_cnt = len(d["image"])
+    if version == 2:
+        img_cnt += sum(len(image.runs()) - 1 for image in sparse.values())
+
     try:
         os.mkdir(now.strftime("%m%d-%H%M%S%f"))
         pack_file = open(now.strftime("%m%d-%H%M%S%f") + "/pack.bin", "wb")
     except (IOError, OSError) as err:
         sys.exit(err)
 
-    out = bytearray(b'\x20\x54\x56\x4e' + b'\xFF' * 12)  # NVT + CRC32 + image count + 4 reserved bytes
+    if version == 2:
+        try:
+            __pack_v2(pack_file, d["image"], sparse, compress)
+        except (IOError, OSError, ValueError) as err:
+            print("Generate pack file failed")
+            pack_file.close()
+            shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
+            sys.exit(err)
+        pack_file.close()
+        __link_output(now.strftime("%m%d-%H%M%S%f"), "pack")
+        print("Generate pack file in directory {} complete".format(now.strftime("%m%d-%H%M%S%f")))
+        return
+
+    # NVT + CRC32 + image count + 4 reserved bytes. CRC and count are patched in once all images are written
+    pack_file.write(PACK_MARKER + b'\xFF' * 12)
+    checksum = Crc32(img_cnt.to_bytes(4, byteorder="little") + b'\xFF' * 4)
+    buf = memoryview(bytearray(PACK_BLOCK))
 
     # Start packing image
-    img_cnt = 0
-    for img in d["image"]:
+    for i, (img, future) in enumerate(__prefetch_images(d["image"], checksum=True)):
         try:
-            with open(img["file"], "rb") as img_file:
-                data = img_file.read()
-        except (IOError, OSError) as err:
-            print(f"Open {img_file} failed")
+            img_start = int(img["offset"], 0)
+        except ValueError as err:
+            pack_file.close()
             shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
             sys.exit(err)
 
-        img_cnt = img_cnt + 1
+        if i in sparse:
+            # FILL chunks are expanded, DONT_CARE chunks are stored as 0xFF
+            __pack_entry(pack_file, checksum, len(sparse[i]), img_start, img["type"])
+            for chunk in split_chunks(sparse[i], PACK_BLOCK, 0, len(sparse[i])):
+                pack_file.write(chunk)
+                checksum.update(chunk)
+            __pack_pad(pack_file, checksum, len(sparse[i]))
+            continue
 
-        img_len = len(data)
-        out += img_len.to_bytes(8, byteorder="little")
         try:
-            out += int(img["offset"], 0).to_bytes(8, byteorder="little")
-        except ValueError as err:
+            img_len, data, img_crc = future.result()
+            if data is None:
+                img_file = open(img["file"], "rb")
+        except (IOError, OSError) as err:
+            print(f"Open {img['file']} failed")
+            pack_file.close()
             shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
             sys.exit(err)
-        out += img["type"].to_bytes(4, byteorder="little")
-        out += b'\xFF' * 4
-        out += data
-        # Always put image start @ 16 byte boundary
-        pad = 16 - (img_len + 8) & 0xF
-        if pad != 16:
-            out += b'\xFF' * pad
-
-    # Fill image count
-    out[8:12] = img_cnt.to_bytes(4, byteorder="little")
-
-    # Fill CRC field
-    crc32_func = crcmod.predefined.mkCrcFun('crc-32')
-    checksum = crc32_func(out[8:])
-    out[4:8] = checksum.to_bytes(4, byteorder="little")
-
-    pack_file.write(out)
+
+        __pack_entry(pack_file, checksum, img_len, img_start, img["type"])
+
+        if data is not None:
+            # Read ahead and hashed by the prefetch thread
+            pack_file.write(data)
+            checksum.combine(img_crc, img_len)
+        else:
+            remain = __copy_file(img_file, pack_file, img_len, buf, checksum)
+            img_file.close()
+            if remain != 0:
+                print(f"{img['file']} changed size while packing")
+                pack_file.close()
+                shutil.rmtree(now.strftime("%m%d-%H%M%S%f"))
+                sys.exit(1)
+
+        __pack_pad(pack_file, checksum, img_len)
+
+    # Fill CRC and image count fields
+    pack_file.seek(4)
+    pack_file.write(checksum.get().to_bytes(4, byteorder="little") + img_cnt.to_bytes(4, byteorder="little"))
     pack_file.close()
-    try:
-        os.unlink("pack")
-    except (IOError, OSError):
-        pass
-    try:
-        os.symlink(now.strftime("%m%d-%H%M%S%f"), "pack")
-    except (IOError, OSError):
-        print("Create symbolic folder pack failed")
+    __link_output(now.strftime("%m%d-%H%M%S%f"), "pack")
     print("Generate pack file in directory {} complete".format(now.strftime("%m%d-%H%M%S%f")))
 
 
@@ -1847,8 +2731,7 @@ def do_showhdr(cfg_file) -> None:
 
     checksum0 = unpack('<I', header_file.read(4))[0]
     buf = header_file.read()
-    crc32_func = crcmod.predefined.mkCrcFun('crc-32')
-    checksum1 = crc32_func(buf)
+    checksum1 = crc32(buf)
     if checksum1 != checksum0:
         print("Checksum is incorrect")
         print(f"Expect {checksum1}, get {checksum0}")
@@ -2041,8 +2924,7 @@ def do_convert(cfg_file, option=OPT_NONE) -> None:
         # Fill image count
         out[36:40] = img_cnt.to_bytes(4, byteorder="little")
         # Fill header checksum
-        crc32_func = crcmod.predefined.mkCrcFun('crc-32')
-        out[4:8] = crc32_func(out[8:]).to_bytes(4, byteorder="little")
+        out[4:8] = crc32(out[8:]).to_bytes(4, byteorder="little")
 
         try:
             with open(now.strftime("%m%d-%H%M%S%f") + "/header.bin", "wb") as header_file:
@@ -2504,14 +3386,14 @@ def do_msc(media, reserve, option=OPT_NONE) -> None:
     global mp_mode
 
     # devices = XUsbComList(attach_all=mp_mode).get_dev()
-    _XUsbComList = XUsbComList(attach_all=mp_mode)
+    _XUsbComList = __open_devices(mp_mode)
     devices = _XUsbComList.get_dev()
 
     if len(devices) == 0:
         print("Device not found")
         sys.exit(2)
 
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
         futures = [executor.submit(__msc, dev, media, reserve, option) for dev in devices]
     success = 0
     failed = 0
@@ -2557,6 +3439,8 @@ def get_option(option) -> int:
         'CONCAT': OPT_CONCAT,
         'SHOWHDR': OPT_SHOWHDR,
         'NOCRC': OPT_NOCRC,
+        'BGCRC': OPT_BGCRC,
+        'BMAP': OPT_BMAP,
         'OTP': OPT_CONVOTP,
         '800': OPT_DDR_800,
         '667': OPT_DDR_667,
@@ -2593,7 +3477,178 @@ def get_otpblock(num) -> int:
     }.get(num, OPT_UNKNOWN)
 
 
-def main():
+def __daemon_socket(address) -> (int, object):
+    # A path is a Unix socket, anything else [host:]port on TCP. The daemon runs any command line it is
+    # sent, so a Unix socket is 0600 and TCP is limited to loopback addresses and needs the token.
+    if os.sep in address or address.startswith('.'):
+        if not hasattr(socket, 'AF_UNIX'):
+            sys.exit("Unix sockets are not supported on this platform, use [host:]port")
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    try:
+        addr = (socket.gethostbyname(host or "127.0.0.1"), int(port, 0))
+    except (ValueError, OSError):
+        sys.exit(f"Wrong daemon address {address}")
+    if not addr[0].startswith("127."):
+        sys.exit(f"Daemon address {address} is not a loopback address")
+    return socket.AF_INET, addr
+
+
+class _DaemonOutput:
+    # stdout ("out") or stderr ("err") of a daemon command, sent to the client as JSON lines
+
+    def __init__(self, wfile, key="out", lock=None):
+        self.wfile = wfile
+        self.key = key
+        self.lock = threading.Lock() if lock is None else lock
+
+    def write(self, text) -> int:
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps({self.key: text}) + "\n").encode())
+            except (IOError, OSError):
+                pass    # Client went away, the command still runs to the end
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def run_command(argv, cwd, output, error=None) -> int:
+    # Run one command line as the CLI would and return its exit status
+    global mp_mode
+
+    mp_mode = False
+    status = 0
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output if error is None else error):
+            main(argv)
+    except SystemExit as err:
+        if err.code is None or isinstance(err.code, int):
+            status = err.code or 0
+        else:
+            print(err.code, file=output)
+            status = 1
+    except Exception:
+        # Keep the daemon up, the failed command gets the traceback
+        output.write(traceback.format_exc())
+        status = 1
+    if status != 0 and session is not None:
+        # Devices may have gone, enumerate again on the next command
+        session["devices"] = None
+        session["attached"] = False
+    return status
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(arg) for arg in request["argv"]]
+            cwd = str(request["cwd"])
+            token = str(request.get("token", ""))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        if self.server.token is not None and not hmac.compare_digest(token, self.server.token):
+            # Any local user can reach a TCP port, only the one reading the token file may run commands
+            status = 1
+            output = _DaemonOutput(self.wfile, "err")
+            output.write("Daemon token mismatch\n")
+        elif "--daemon" in argv:
+            status = 1
+        else:
+            output = _DaemonOutput(self.wfile)
+            status = run_command(argv, cwd, output, _DaemonOutput(self.wfile, "err", output.lock))
+        try:
+            self.wfile.write((json.dumps({"exit": status}) + "\n").encode())
+        except (IOError, OSError):
+            pass
+
+
+def do_daemon(address) -> None:
+    # Own the USB devices and run commands sent by --connect one at a time. Devices are
+    # enumerated once and remembered as attached, so attach is not repeated per command.
+    global session
+
+    family, addr = __daemon_socket(address)
+    session = {"devices": None, "attached": False}
+    if family == socket.AF_INET:
+        token = secrets.token_hex(32)
+        try:
+            fd = os.open(DAEMON_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, 0o600)    # Made before by someone else
+            with os.fdopen(fd, "w") as token_file:
+                token_file.write(token)
+        except (IOError, OSError) as err:
+            print(f"Write {DAEMON_TOKEN_FILE} failed")
+            sys.exit(err)
+        server = socketserver.TCPServer(addr, _DaemonHandler)
+        server.token = token
+    else:
+        if os.path.exists(addr):
+            os.unlink(addr)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.UnixStreamServer(addr, _DaemonHandler)
+        finally:
+            os.umask(umask)
+        server.token = None
+    print(f"NuWriter daemon listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if family != socket.AF_INET:
+            os.unlink(addr)
+        else:
+            with contextlib.suppress(OSError):
+                os.unlink(DAEMON_TOKEN_FILE)
+
+
+def do_connect(address, argv) -> int:
+    # Send a command line to the daemon and print its output, return its exit status
+    family, addr = __daemon_socket(address)
+    request = {"argv": argv, "cwd": os.getcwd()}
+    try:
+        if family == socket.AF_INET:
+            with open(DAEMON_TOKEN_FILE, "r") as token_file:
+                request["token"] = token_file.read().strip()
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.connect(addr)
+            stream = sock.makefile("rwb")
+            stream.write((json.dumps(request) + "\n").encode())
+            stream.flush()
+            for line in stream:
+                reply = json.loads(line)
+                if "exit" in reply:
+                    return reply["exit"]
+                out = sys.stderr if "err" in reply else sys.stdout
+                out.write(reply.get("err", reply.get("out", "")))
+                out.flush()
+    except (IOError, OSError, ValueError) as err:
+        print(f"Connect to daemon {address} failed")
+        sys.exit(err)
+    print("Daemon closed the connection")
+    return 1
+
+
+def main(argv=None):
+    # Registry changes of the command are kept in memory and written to .config once it is done
+    try:
+        __main(argv)
+    finally:
+        if save_config() is False:
+            print("Write .config failed. Please re-attach")
+            sys.exit(1)
+
+
+def __main(argv):
     parser = argparse.ArgumentParser()
 
     parser.add_argument("CONFIG", nargs='?', help="Config file", type=str, default='')
@@ -2601,6 +3656,24 @@ def main():
     parser.add_argument("-a", "--attach", action='store_true', help="Attach to MA35 Series")
     parser.add_argument("-o", "--option", nargs='+', help="Option flag")
     parser.add_argument("-t", "--type", nargs='+', help="Type flag")
+    parser.add_argument("--window", type=int, default=1, help="Transfer chunks in flight before ack, 1 is lock-step")
+    parser.add_argument("--skip-erased", action='store_true',
+                        help="Do not send trailing all 0xFF blocks when programming NAND/SPI NAND data images")
+    parser.add_argument("--decompress", action='store_true',
+                        help="Image to write is gzip, xz or zstd compressed, program its decompressed content")
+    parser.add_argument("--chunk-size", type=str, default=str(TRANSFER_SIZE),
+                        help="Transfer chunk size for flash media, or auto to tune it per device and media")
+    parser.add_argument("--erase-first", action='store_true',
+                        help="Erase the whole flash media of each device right before writing it")
+    parser.add_argument("--station", nargs='?', type=int, const=0, metavar="BOARDS",
+                        help="Attach and program each board as it is plugged in, stop after BOARDS if given")
+    parser.add_argument("--events", choices=['json'],
+                        help="Write progress and results to stdout as JSON lines, the text log goes to stderr")
+    parser.add_argument("--daemon", nargs='?', const=DAEMON_ADDRESS, metavar="ADDRESS",
+                        help=f"Keep devices open and run commands sent with --connect, default {DAEMON_ADDRESS}. "
+                             f"On TCP --connect needs the token the daemon writes to {DAEMON_TOKEN_FILE}")
+    parser.add_argument("--connect", nargs='?', const=DAEMON_ADDRESS, metavar="ADDRESS",
+                        help="Run this command in a NuWriter daemon")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("-c", "--convert", action='store_true', help="Convert images")
     group.add_argument("-p", "--pack", action='store_true', help="Generate pack file")
@@ -2611,19 +3684,50 @@ def main():
     group.add_argument("-s", "--storage", nargs='+', help="Export eMMC/SD as Mass Storage Class")
     
 
-    if len(sys.argv) == 1:
+    if argv is None and len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
         
     global mp_mode
-
-    args = parser.parse_args()
+    global xfer_window
+    global chunk_size
+    global skip_erased
+    global decompress
+    global device_phases
+    global station
+    global slot_stats
+    global port_labels
+
+    args = parser.parse_args(argv)
+
+    if args.daemon:
+        do_daemon(args.daemon)
+        return
+    if args.connect:
+        # Everything but --connect is run by the daemon
+        argv = sys.argv[1:] if argv is None else argv
+        forward = argv
+        for index, arg in enumerate(argv):
+            if arg == "--connect":
+                # The address is the next argument unless the default was used
+                end = index + 2 if argv[index + 1: index + 2] == [args.connect] else index + 1
+                forward = argv[:index] + argv[end:]
+            elif arg.startswith("--connect="):
+                forward = argv[:index] + argv[index + 1:]
+        sys.exit(do_connect(args.connect, forward))
 
     if args.option:
         option = get_option(args.option[0])
     else:
         option = OPT_NONE
 
+    if args.events == 'json':
+        # Events own stdout, the text log moves to stderr and the bars are left out
+        set_event_sink(_json_events(sys.stdout), bars=False)
+        sys.stdout = sys.stderr
+    else:
+        set_event_sink(None)
+
     if option is OPT_UNKNOWN:
         print("Unknown option: " + args.option[0])
         sys.exit(0)
@@ -2634,17 +3738,58 @@ def main():
 
     cfg_file = args.CONFIG
 
+    if args.window < 1:
+        print("Transfer window must be at least 1")
+        sys.exit(0)
+    xfer_window = args.window
+    skip_erased = args.skip_erased
+    decompress = args.decompress
+
+    try:
+        chunk_size = CHUNK_AUTO if str.upper(args.chunk_size) == 'AUTO' else int(args.chunk_size, 0)
+        if chunk_size != CHUNK_AUTO and not 0 < chunk_size <= MAX_XFER_LEN:
+            raise ValueError(f"Chunk size must be 1 ~ {MAX_XFER_LEN} or auto")
+    except ValueError as err:
+        sys.exit(err)
+
     if args.massproduct:
         mp_mode = True
         #print(f'NuWriter mp_mode = {mp_mode}')
 
+    # Attach and erase along with writing or erasing flash run per device, see __run_devices()
+    device_phases = []
+    slot_stats = {}
+    # Slots follow the ports.txt of the directory a command runs in
+    port_labels = None
+    with slot_lock:
+        device_slots.clear()
+    flash = DEV_UNKNOWN
+    if args.write and len(args.write) >= 2 and get_media(args.write[0]) not in [DEV_OTP, DEV_USBD]:
+        flash = get_media(args.write[0])
+    elif args.erase and get_media(args.erase[0]) not in [DEV_OTP, DEV_DDR_SRAM]:
+        flash = get_media(args.erase[0])
+
     if args.attach:
         if not cfg_file:
             print("Please assign a DDR ini file")
             sys.exit(0)
-        if do_attach(cfg_file, option) > 0:
+        if flash != DEV_UNKNOWN and "enc_ma35_nuwriter.bin" not in cfg_file and \
+           (session is None or session["attached"] is False):
+            device_phases = __attach_phases(cfg_file, option)
+        elif do_attach(cfg_file, option) > 0:
             sys.exit(1)
 
+    if args.erase_first and args.write and flash not in [DEV_UNKNOWN, DEV_DDR_SRAM]:
+        device_phases.append(__erase_phase(flash))
+
+    station = args.station
+    if station is not None:
+        # Boards come in running the boot ROM, every one needs the attach phases
+        if station < 0 or len(device_phases) == 0 or device_phases[0][0] != "Attach":
+            print("--station takes -a with a flash write or erase")
+            sys.exit(0)
+        mp_mode = True
+
     if args.convert:
         if cfg_file == '':
             print("No config file assigned")
@@ -2658,6 +3803,9 @@ def main():
             elif option == OPT_CONVOTP:
                 # -o otp -c otp.json
                 do_otp_convert(cfg_file)
+            elif option == OPT_BMAP:
+                # -o bmap -c disk.img
+                create_bmap(cfg_file)
             else:
                 do_convert(cfg_file, option)
     elif args.pack:
@@ -22,7 +22,7 @@ from nuwriter import (DEV_DDR_SRAM, DEV_NAND, DEV_OTP, DEV_SD_EMMC,
         OPT_OTPBLK1, OPT_OTPBLK2, OPT_OTPBLK3, OPT_OTPBLK4, OPT_OTPBLK5, OPT_OTPBLK6, OPT_OTPBLK7,
         do_attach, do_convert, do_nuwriter, do_pack, do_stuff, do_txt_convert, do_unpack, 
         do_img_erase, do_img_program, do_img_read, do_otp_program, do_otp_erase, do_otp_read, do_otp_convert,
-        do_pack_program, do_msc, switch_mp_mode, mp_mode)        
+        do_pack_program, do_msc, switch_mp_mode, mp_mode, set_event_sink, save_config)        
 
 from mainwindow import Ui_MainWindow
 from gui.mediaPages import MediaPage
@@ -35,6 +35,8 @@ from gui.progress import ProgressDialog
 
 Version = "v1.09"
 
+ANSI_RE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
+
 class EmittingStream(QtCore.QObject):
 
     textWritten = QtCore.pyqtSignal(str)
@@ -85,6 +87,8 @@ class UpdateDialog(QtWidgets.QDialog):
 
 class Ui(QtWidgets.QMainWindow, Ui_MainWindow):
     numbersChanged = QtCore.pyqtSignal(str, int, int, int, int)
+    # Events of nuwriter come from its device threads, the signal hands them to the GUI thread
+    eventReceived = QtCore.pyqtSignal(dict)
     
     def __init__(self):
         QtWidgets.QMainWindow.__init__(self) # Call the inherited classes __init__ method
@@ -107,6 +111,7 @@ class Ui(QtWidgets.QMainWindow, Ui_MainWindow):
         self.initToolSetting()
         
         self.Progress_window = ProgressDialog(self)
+        self.eventReceived.connect(self.progressEventReceived)
 
         # Attach
         self.browseDDR_btn.clicked.connect(self.iniBrowseDDR)
@@ -160,6 +165,9 @@ class Ui(QtWidgets.QMainWindow, Ui_MainWindow):
         self.groupBox_a2.setVisible(False)
         self.groupBox_a3.setVisible(False)
         self.attach_btn_2.setVisible(False)
+
+        # Progress of mass production comes to the progress dialog as events instead of text bars
+        set_event_sink(self.eventReceived.emit, bars=not self.mass_mode)
         
         # ToolBar setting         
         self.actionDev.triggered.connect(self.dev_mode_check)
@@ -248,6 +256,7 @@ class Ui(QtWidgets.QMainWindow, Ui_MainWindow):
     def mp_mode_check(self):
         switch_mp_mode(True)
         self.mass_mode = not self.mass_mode
+        set_event_sink(self.eventReceived.emit, bars=not self.mass_mode)
         
     def ct_mode_check(self):
         self.ct_mode = not self.ct_mode
@@ -543,67 +552,24 @@ class Ui(QtWidgets.QMainWindow, Ui_MainWindow):
         self.text_browser.insertPlainText(text)
         self.text_browser.moveCursor(QtGui.QTextCursor.End)
 
+    def progressEventReceived(self, event):
+        if event["event"] != "progress" or not self.mass_mode:
+            return
+        if event["phase"] not in ("Programming", "Verifying", "Erasing") or not event["total"]:
+            return
+        if not self.Progress_window.isVisible():
+            self.showProgress()
+        pct = min(int(event["done"] * 100 / event["total"]), 100)
+        self.Progress_window.updateRequested.emit(event["phase"], event["slot"] + 1, pct,
+                                                  event["image"], event["images"])
+
     def progressOutputWritten(self, raw_text):
         try:
-            ANSI_RE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
-            
             cleaned = ANSI_RE.sub('', raw_text)
             
             if not cleaned or cleaned in ('\n', '\r\n'):
                 return
                 
-            BAR_PCK_RE = re.compile(
-                r'''
-                    ^device\s+
-                    (?P<dev>\d+)\s+                       # ← dev.get_id()
-                    (?P<action>Programming|Verifying)\s+  # literal word
-                    (?P<i>\d+)/(?P<X>\d+)\s*              # x / X
-                    :?\s*                                 # tqdm adds “:  ”
-                    [^\d%]*?                              # skip to first %
-                    (?P<pct>\d{1,3})%                     # 0-100
-                ''',
-                re.X | re.ASCII
-            )
-            
-            BAR_RE = re.compile(
-                r'''
-                    ^device\s+
-                    (?P<dev>\d+)\s+                       # ← dev.get_id()
-                    (?P<action>Programming|Verifying)\s+  # literal word
-                    :?\s*                                 # tqdm adds “:  ”
-                    [^\d%]*?                              # skip to first %
-                    (?P<pct>\d{1,3})%                     # 0-100
-                ''',
-                re.X | re.ASCII
-            )
-            
-            text = ANSI_RE.sub('', raw_text).lstrip('\r')
-            if not text or text in ('\n', '\r\n'):
-                return
-       
-            bar_pck_m = BAR_PCK_RE.match(text) 
-            bar_m = BAR_RE.match(text)
-            
-            if bar_pck_m and self.mass_mode:
-                phase = bar_pck_m['action'].strip()
-                pos = int(bar_pck_m['dev']) + 1
-                pct = int(bar_pck_m['pct'])
-                img_i = int(bar_pck_m['i'])
-                img_x = int(bar_pck_m['X'])
-                if not self.Progress_window.isVisible():
-                    self.showProgress()
-                self.Progress_window.updateRequested.emit(phase, pos, pct, img_i, img_x)
-                return
-                
-            elif bar_m and self.mass_mode:
-                phase = bar_m['action'].strip()
-                pos = int(bar_m['dev']) + 1
-                pct = int(bar_m['pct'])
-                if not self.Progress_window.isVisible():
-                    self.showProgress()
-                self.Progress_window.updateRequested.emit(phase, pos, pct, 0, 0)
-                return
-                
             if '\r' in cleaned and '\n' not in cleaned:
                 last = cleaned.split('\r')[-1]
                 if last.strip():
@@ -1171,6 +1137,9 @@ class Worker(QRunnable):
         except:
             print('except')
             pass
+        # Registry changes of the command are written to .config once it is done
+        if save_config() is False:
+            print('Write .config failed')
         self.signals.finished.emit()
 
 if __name__ == "__main__":
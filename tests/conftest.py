@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Tests run nuwriter against the emulated devices of MockDevice, no hardware needed.
+import os
+import sys
+import shutil
+import struct
+import pytest
+
+PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE)
+
+
+@pytest.fixture
+def mock(tmp_path, monkeypatch):
+    # Empty station in a work directory holding ddr.bin and xusb.bin, plug() boards into it
+    monkeypatch.setenv("NUWRITER_MOCK", "0")
+    ddr = sorted(name for name in os.listdir(os.path.join(PACKAGE, "ddrimg")) if name.endswith(".bin"))[0]
+    shutil.copy(os.path.join(PACKAGE, "ddrimg", ddr), tmp_path / "ddr.bin")
+    shutil.copy(os.path.join(PACKAGE, "xusb.bin"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    import MockDevice
+    import nuwriter
+    MockDevice.reset(0)
+    nuwriter.device_slots.clear()
+    nuwriter.chunk_probe.clear()
+    return MockDevice
+
+
+def run(argv) -> int:
+    # nuwriter.main() as the command line runs it, return its exit status
+    import nuwriter
+    try:
+        nuwriter.main(argv)
+    except SystemExit as err:
+        return err.code if isinstance(err.code, int) else 1
+    return 0
+
+
+def flash(board, media, length) -> bytes:
+    # First length bytes a board holds on a media, pages never written read as 0xFF
+    import MockDevice
+    pages = board.storage.get(media, {})
+    data = b''.join(bytes(pages.get(page, b'\xFF' * MockDevice.PAGE))
+                    for page in range(-(-length // MockDevice.PAGE)))
+    return data[0: length]
+
+
+def sparse(file_name, block, chunks) -> bytes:
+    # Write an Android sparse image of (type, block count, payload) chunks, return what it expands to
+    # with DONT_CARE as 0xFF
+    body = b''
+    content = b''
+    for chunk_type, count, payload in chunks:
+        body += struct.pack('<HHII', chunk_type, 0, count, 12 + len(payload)) + payload
+        if chunk_type == 0xCAC1:
+            content += payload
+        elif chunk_type == 0xCAC2:
+            content += payload * (count * block // 4)
+        else:
+            content += b'\xFF' * (count * block)
+    with open(file_name, "wb") as image_file:
+        image_file.write(struct.pack('<IHHHHIIII', 0xED26FF3A, 1, 0, 28, 12, block, len(content) // block,
+                                     len(chunks), 0) + body)
+    return content
+
+
+def record_writes(monkeypatch, boards) -> list:
+    # List that collects the write commands the boards receive
+    import nuwriter
+    writes = []
+    for board in boards:
+        def command(data, command=board._MockDevice__command):
+            if data[16] == nuwriter.ACT_WRITE:
+                writes.append(data)
+            command(data)
+        monkeypatch.setattr(board, "_MockDevice__command", command)
+    return writes
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import json
+import threading
+import pytest
+import nuwriter
+import xusbcom
+from xusbcom import XUsbCom
+from conftest import run, flash, sparse, record_writes
+
+
+def test_attach_program_verify(mock, capsys):
+    board = mock.plug(0)
+    image = os.urandom(0x30000)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(image)
+
+    assert run(["-a", "ddr.bin"]) == 0
+    assert board.xusb is True
+    assert run(["-w", "spinor", "0x10000", "image.bin", "-o", "verify"]) == 0
+    assert "Verify pass" in capsys.readouterr().out
+    assert flash(board, nuwriter.DEV_SPINOR, 0x40000)[0x10000:] == image
+
+    assert run(["-r", "spinor", "0x10000", hex(len(image)), "out.bin"]) == 0
+    with open("out.bin", "rb") as out_file:
+        assert out_file.read() == image
+
+
+def test_verify_mismatch(mock, capsys, monkeypatch):
+    board = mock.plug(0)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(os.urandom(0x8000))
+    assert run(["-a", "ddr.bin"]) == 0
+
+    # Flash that drops the last byte of every write
+    store = board._MockDevice__store
+    monkeypatch.setattr(board, "_MockDevice__store", lambda offset, data: store(offset, data[:-1]))
+    assert run(["-w", "spinor", "0", "image.bin", "-o", "verify"]) != 0
+    assert "Verify pass" not in capsys.readouterr().out
+    # The failed device closed its progress bars
+    assert nuwriter.progress_active == []
+
+
+def test_decompress_nand(mock, capsys, monkeypatch):
+    # A compressed image spanning several decompressed segments goes to SPI NAND in one write command
+    boards = [mock.plug(0), mock.plug(1)]
+    writes = record_writes(monkeypatch, boards)
+    image = os.urandom(0x500000) + os.urandom(1234)
+    with open("image.gz", "wb") as image_file:
+        image_file.write(gzip.compress(image, 1))
+    assert run(["-a", "ddr.bin", "-w", "spinand", "0", "image.gz", "--decompress", "-o", "verify", "-m"]) == 0
+    assert capsys.readouterr().out.count("Verify pass") == 2
+    assert len(writes) == 2
+    for board in boards:
+        assert flash(board, nuwriter.DEV_SPINAND, len(image)) == image
+
+
+def test_sparse_nand(mock, capsys, monkeypatch):
+    # DONT_CARE chunks go to SPI NAND as 0xFF in the one write command, SPI NOR skips them
+    board = mock.plug(0)
+    writes = record_writes(monkeypatch, [board])
+    block = 0x1000
+    image = sparse("image.img", block, [(0xCAC1, 2, os.urandom(2 * block)), (0xCAC3, 40, b''),
+                                        (0xCAC2, 3, b'\x5A\xA5\x01\x02'), (0xCAC3, 1, b''),
+                                        (0xCAC1, 1, os.urandom(block))])
+    assert run(["-a", "ddr.bin", "-w", "spinand", "0", "image.img", "-o", "verify"]) == 0
+    assert "Verify pass" in capsys.readouterr().out
+    assert len(writes) == 1
+    assert flash(board, nuwriter.DEV_SPINAND, len(image)) == image
+
+    writes.clear()
+    assert run(["-w", "spinor", "0", "image.img", "-o", "verify"]) == 0
+    assert len(writes) == 3
+
+
+def test_command_waits_for_busy_device(mock):
+    board = mock.plug(0)
+    board.xusb = True
+    board.state = 'cmd'
+    dev = XUsbCom(board)
+    erase = (0).to_bytes(8, "little") + (0).to_bytes(8, "little") + (3).to_bytes(4, "little") + \
+        (0).to_bytes(4, "little")
+
+    # NAKed for 0.3s after a write, like SPI NAND finishing the last page
+    board.busy_until = mock.time.monotonic() + 0.3
+    assert int.from_bytes(dev.command(erase, timeout=2000), "little") == nuwriter.ACK
+    assert dev.ready_wait >= 0.3
+
+    board.state = 'cmd'
+    board.out = bytearray()
+    board.busy_until = mock.time.monotonic() + 5
+    with pytest.raises(SystemExit):
+        dev.command(erase, timeout=300)
+
+
+def test_chunk_size_probe_small_images(mock, capsys):
+    # Images too small to time every chunk size still record the fastest, the next image probes the rest
+    mock.plug(0)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(os.urandom(0x300000))
+    assert run(["-a", "ddr.bin"]) == 0
+    assert run(["-w", "spinor", "0", "image.bin", "--chunk-size", "auto"]) == 0
+    assert "1 size(s) left to probe" in capsys.readouterr().out
+    with open(".config") as config_file:
+        assert str(nuwriter.DEV_SPINOR) in list(json.load(config_file)["chunk_size"].values())[0]
+
+    assert run(["-w", "spinor", "0", "image.bin", "--chunk-size", "auto"]) == 0
+    assert "selected" in capsys.readouterr().out
+    assert run(["-w", "spinor", "0", "image.bin", "--chunk-size", "auto"]) == 0
+    assert "Chunk size" not in capsys.readouterr().out
+
+
+def test_64_devices(mock, capsys):
+    # Mass production is not held to a fixed number of devices, each board gets a slot of its own
+    boards = [mock.plug(i) for i in range(64)]
+    image = os.urandom(0x20000)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(image)
+    assert run(["-a", "ddr.bin", "-w", "spinor", "0", "image.bin", "-m"]) == 0
+    assert "Successfully programmed 64 device(s)" in capsys.readouterr().out
+    for board in boards:
+        assert flash(board, nuwriter.DEV_SPINOR, len(image)) == image
+    assert sorted(nuwriter.device_slots.values()) == list(range(64))
+
+
+def test_config_saved_once_per_command(mock, monkeypatch):
+    # Device threads only change the registry in memory, the command writes .config once at its end
+    for i in range(8):
+        mock.plug(i)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(os.urandom(0x300000))
+    save = xusbcom._save_config
+    threads = []
+
+    def count():
+        threads.append(threading.current_thread())
+        return save()
+    monkeypatch.setattr(xusbcom, "_save_config", count)
+    assert run(["-a", "ddr.bin", "-w", "spinor", "0", "image.bin", "--chunk-size", "auto", "-m"]) == 0
+    assert threads == [threading.main_thread()]
+    with open(".config") as config_file:
+        config = json.load(config_file)
+    assert len(config["devices"]) == len(config["xusb"]) == len(config["chunk_size"]) == 8
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import gzip
+import pytest
+import nuwriter
+from conftest import run, flash, sparse, record_writes
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def make_pack(compress) -> dict:
+    # Pack v2 of a raw image, an image compressed while packing and a gzip image stored as is.
+    # Return {offset: content} of what the pack programs.
+    images = {0: os.urandom(777),
+              0x100000: os.urandom(0x50000) + b'\xFF' * 0x30000,
+              0x200000: os.urandom(0x40000)}
+    for offset, content in images.items():
+        with open(f"img{offset:x}.bin", "wb") as image_file:
+            image_file.write(content)
+    with open("img200000.gz", "wb") as image_file:
+        image_file.write(gzip.compress(images[0x200000]))
+    with open("pack.json", "w") as json_file:
+        json.dump({"version": 2, "image": [
+            {"offset": "0x0", "file": "img0.bin", "type": 0},
+            {"offset": "0x100000", "file": "img100000.bin", "type": 0, "compress": compress},
+            {"offset": "0x200000", "file": "img200000.gz", "type": 0, "compressed": True}]}, json_file)
+    assert run(["-p", "pack.json"]) == 0
+    return images
+
+
+@pytest.mark.parametrize("compress", ["zlib", pytest.param("zstd", marks=pytest.mark.skipif(
+    zstandard is None, reason="zstandard not installed"))])
+def test_pack_v2_round_trip(mock, compress):
+    images = make_pack(compress)
+    assert run(["-p", "pack/pack.bin", "-o", "unpack"]) == 0
+    for i, content in enumerate(images.values()):
+        with open(f"unpack/img{i}.bin", "rb") as image_file:
+            assert image_file.read() == content
+
+
+def test_pack_v2_program_devices(mock, capsys):
+    # Mass production programs and verifies every board
+    boards = [mock.plug(i) for i in range(3)]
+    images = make_pack("zlib")
+    assert run(["-a", "ddr.bin", "-w", "spinand", "pack/pack.bin", "-o", "verify", "-m"]) == 0
+    assert "Successfully programmed 3 device(s)" in capsys.readouterr().out
+    for board in boards:
+        content = flash(board, nuwriter.DEV_SPINAND, 0x300000)
+        for offset, image in images.items():
+            assert content[offset: offset + len(image)] == image
+
+
+def test_pack_v1_rejects_compressed(mock, capsys):
+    make_pack("zlib")
+    with open("pack.json") as json_file:
+        config = json.load(json_file)
+    del config["version"]
+    config["image"][1]["compress"] = "none"
+    with open("pack.json", "w") as json_file:
+        json.dump(config, json_file)
+    run(["-p", "pack.json"])
+    assert "needs \"version\": 2" in capsys.readouterr().out
+
+
+def test_pack_v2_sparse_nand(mock, monkeypatch):
+    # The runs of a sparse image are separate entries, SPI NAND gets them back in one write command
+    board = mock.plug(0)
+    writes = record_writes(monkeypatch, [board])
+    block = 0x1000
+    image = sparse("image.img", block, [(0xCAC3, 1, b''), (0xCAC1, 2, os.urandom(2 * block)),
+                                        (0xCAC3, 40, b''), (0xCAC2, 3, b'\x5A\xA5\x01\x02')])
+    with open("small.bin", "wb") as image_file:
+        image_file.write(b'small')
+    with open("pack.json", "w") as json_file:
+        json.dump({"version": 2, "image": [
+            {"offset": "0x0", "file": "small.bin", "type": 0},
+            {"offset": "0x100000", "file": "image.img", "type": 0, "compress": "zlib"}]}, json_file)
+    assert run(["-p", "pack.json"]) == 0
+    assert run(["-a", "ddr.bin", "-w", "spinand", "pack/pack.bin", "-o", "verify"]) == 0
+    assert len(writes) == 2
+    assert flash(board, nuwriter.DEV_SPINAND, 0x100000 + len(image))[0x100000:] == image
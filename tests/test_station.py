@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+import threading
+import contextlib
+import nuwriter
+from conftest import run, flash
+
+
+class _Operator(io.StringIO):
+    # Swaps the board on a port once the station reports it, keeps every board plugged in
+
+    def __init__(self, mock, boards):
+        super().__init__()
+        self.mock = mock
+        self.boards = boards
+        self.timers = []
+
+    def write(self, text) -> int:
+        for port in re.findall(r"Port 1-(\d+) (?:passed|FAILED)", text):
+            self.mock.unplug(int(port) - 1)
+            self.timers.append(threading.Timer(0.05, self.plug, args=(int(port) - 1,)))
+            self.timers[-1].start()
+        return super().write(text)
+
+    def plug(self, index) -> None:
+        self.boards.append(self.mock.plug(index))
+
+
+def test_station_hot_plug(mock):
+    image = os.urandom(0x20000)
+    with open("image.bin", "wb") as image_file:
+        image_file.write(image)
+    boards = [mock.plug(0), mock.plug(1)]
+    output = _Operator(mock, boards)
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        status = run(["-a", "ddr.bin", "-w", "spinor", "0", "image.bin", "-o", "verify", "--station", "5"])
+    for timer in output.timers:
+        timer.join()
+    assert status == 0, output.getvalue()
+    assert len(re.findall(r"Port 1-\d+ passed", output.getvalue())) == 5
+    # Each board swapped in was programmed once, the boards still plugged in after the 5th may not be
+    programmed = [board for board in boards if flash(board, nuwriter.DEV_SPINOR, len(image)) == image]
+    assert len(programmed) == 5
+    assert all(board.xusb is True for board in programmed)
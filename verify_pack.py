@@ -3,7 +3,8 @@ import os
 import sys
 import subprocess
 import time
-from UnpackImage import UnpackImage
+from UnpackImage import UnpackImage, COMPRESS_NONE
+from StreamImage import StreamImage
 
 def calculate_timeout(size_bytes):
     """
@@ -102,7 +103,12 @@ def verify_in_memory():
             except:
                 pass
 
-            expected_data = packer.img_content(i, 0, length)
+            if packer.img_sha256(i) is not None and packer.img_compress(i) != COMPRESS_NONE:
+                # Pack v2 compressed image, flash holds the decompressed content
+                expected_data = b''.join(bytes(data) for offset, data in
+                                         StreamImage(packer.img_stored(i), compress=packer.img_compress(i)))
+            else:
+                expected_data = packer.img_content(i, 0, length)
 
             if flash_mem_data != expected_data:
                 for b in range(len(expected_data)):
@@ -2,14 +2,123 @@
 
 __copyright__ = "Copyright (C) 2020~2021 Nuvoton Technology Corp. All rights reserved"
 
+import os
 import sys
+import time
 import usb.core
 import usb.util
 import json
 import typing
+import collections
+import threading
+from struct import unpack
 
 XFER_LEN_CMD = 0x0012
 GET_INFO_CMD = 0x0005
+# Transfer length goes in wIndex of the XFER_LEN_CMD vendor request
+MAX_XFER_LEN = 0xFFFF
+# ms xusb may take to accept a command and ACK it, e.g. while SPI NAND is still programming the last image
+READY_TIMEOUT = 10000
+READY_POLL = 500        # ms each try of a command gets before it is sent or its ACK read again
+VID = 0x0416
+PID = 0x5963
+ENUM_TIMEOUT = 20.0     # Seconds devices get to re-enumerate running xusb after it is loaded
+ENUM_POLL = 0.05        # First delay between polls for re-enumerated devices, doubled up to ENUM_POLL_MAX
+ENUM_POLL_MAX = 0.5
+PROBE_TIMEOUT = 1000    # ms a freshly enumerated device gets to answer get_info before it is polled again
+DRAIN_TIMEOUT = 10      # ms to wait for stale IN data left by an aborted transfer before probing
+ACK = 0x55AA55AA
+
+# Device geometry from get_info, tuned chunk sizes and xusb addresses, kept in .config. Changes stay in
+# memory until save_config(), device threads never write the file.
+CONFIG_FILE = ".config"
+ALIGN_KEYS = ('nand_align', 'spinand_align', 'nand_page', 'nand_block', 'nand_block_cnt', 'nand_oob',
+              'spinand_page', 'spinand_block', 'spinand_block_cnt', 'spinand_oob', 'emmc_block')
+_config_lock = threading.Lock()
+_config = None
+_config_path = ''
+_config_dirty = False
+_ready_lock = threading.Lock()
+_ready_claimed = set()  # (bus, address) of devices a wait has taken, until the list holding them is released
+
+
+def _load_config() -> dict:
+    # .config of the current directory, parsed once and then served from memory. Call with _config_lock held.
+    global _config, _config_path, _config_dirty
+    path = os.path.abspath(CONFIG_FILE)
+    if _config is None or path != _config_path:
+        if _config_dirty is True and _save_config() is False:
+            print(f"Write {_config_path} failed")
+        _config_dirty = False
+        try:
+            with open(path, "r") as json_file:
+                _config = json.load(json_file)
+            if not isinstance(_config, dict):
+                raise ValueError(f"{path} is not a JSON object")
+        except (IOError, OSError, ValueError) as err:
+            _config = {}
+        _config_path = path
+    return _config
+
+
+def _save_config() -> bool:
+    # Write a temporary file and rename it over .config, a reader never sees it half written
+    temp_path = f"{_config_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "w") as json_file:
+            json.dump(_config, json_file, indent = 4)
+        os.replace(temp_path, _config_path)
+    except (IOError, OSError) as err:
+        return False
+    return True
+
+
+def _config_changed() -> None:
+    # Call with _config_lock held
+    global _config_dirty
+    _config_dirty = True
+
+
+def save_config() -> bool:
+    # Write the registry changes made since the last save, once per command from the main thread
+    global _config_dirty
+    with _config_lock:
+        if _config_dirty is False:
+            return True
+        _config_dirty = False
+        return _save_config()
+
+
+def find_devices(**kwargs):
+    # usb.core.find(), or emulated devices when NUWRITER_MOCK gives how many
+    if os.environ.get("NUWRITER_MOCK"):
+        import MockDevice   # Not needed, nor shipped, for real hardware
+        return MockDevice.find(**kwargs)
+    return usb.core.find(**kwargs)
+
+
+def port_path(dev):
+    # Bus and hub ports of a device, these stay the same when it re-enumerates. None if the backend can't tell.
+    try:
+        ports = dev.port_numbers
+    except (usb.core.USBError, NotImplementedError):
+        ports = None
+    return (dev.bus,) + tuple(ports) if ports else None
+
+
+def split_chunks(data, chunk_size, start=0, end=None):
+    end = len(data) if end is None else end
+    for offset in range(start, end, chunk_size):
+        yield data[offset: min(offset + chunk_size, end)]
+
+
+def _sane_info(info) -> bool:
+    # NAND and SPI NAND page size and pages per block are powers of two, 0 if there is no such flash
+    fields = unpack('<IIIIIIIIBBBBIIIIIHHBBBBIIIBBBBI', bytes(info))
+    for value in (fields[0], fields[1], fields[17], fields[25]):
+        if value & (value - 1) != 0 or value > 0x10000:
+            return False
+    return True
 
 
 class XUsbCom:
@@ -21,9 +130,11 @@ class XUsbCom:
         self.attach = False
         self.id = 0
         self.info = b''
+        self.ready_wait = 0.0   # Seconds spent in command() waiting for ACKs
         
         self.bus = 0
         self.address = 0
+        self.port = port_path(_dev)
 
     def write(self, data) -> None:
         try:
@@ -34,6 +145,55 @@ class XUsbCom:
         except usb.core.USBError as err:
             sys.exit(err)
 
+    def command(self, cmd, timeout=READY_TIMEOUT) -> bytes:
+        # Send a command and return its ACK as soon as xusb is ready for it. A busy xusb may NAK the
+        # command or hold back its ACK, so both are tried again every READY_POLL ms up to timeout ms.
+        begin = time.perf_counter()
+        deadline = begin + timeout / 1000
+        sent = False
+        while True:
+            try:
+                if sent is False:
+                    self.dev.ctrl_transfer(0x40, 0xA0, wValue=XFER_LEN_CMD, wIndex=len(cmd), data_or_wLength='')
+                    self.dev.write(self.write_addr, cmd, timeout=READY_POLL)
+                    sent = True
+                ack = self.dev.read(self.read_addr, 4, timeout=READY_POLL)
+                break
+            except usb.core.USBTimeoutError as err:
+                if time.perf_counter() >= deadline:
+                    sys.exit(err)
+            except usb.core.USBError as err:
+                sys.exit(err)
+        self.ready_wait += time.perf_counter() - begin
+        return ack
+
+    def write_chunks(self, chunks, window=1, progress=None, ack_last=True) -> int:
+        # Send each chunk and check the 4-byte length ack xusb returns for it. Up to window
+        # chunks are kept in flight before their acks are read, window 1 is the lock-step transfer.
+        # With ack_last False the acks still pending are read before the last chunk, which has none.
+        in_flight = collections.deque()
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+        while chunk is not None:
+            following = next(chunks, None)
+            no_ack = following is None and ack_last is False
+            if no_ack is False:
+                self.write(chunk)
+                in_flight.append(len(chunk))
+                chunk = following
+            while len(in_flight) >= window or ((chunk is None or no_ack) and len(in_flight) > 0):
+                xfer_size = in_flight.popleft()
+                ack = int.from_bytes(self.read(4), byteorder="little")
+                if ack != xfer_size:
+                    print(f"Ack size error {ack} {xfer_size}")
+                    return -1
+                if progress is not None:
+                    progress(xfer_size)
+            if no_ack is True:
+                self.write(chunk)
+                break
+        return 0
+
     def read(self, size) -> bytes:
         try:
             buf = self.dev.read(self.read_addr, size, timeout=1000)
@@ -62,6 +222,31 @@ class XUsbCom:
             sys.exit(err)
         return self.info
 
+    def probe_info(self, data, timeout=PROBE_TIMEOUT) -> bool:
+        # get_info that fails instead of exiting, for devices that may not be running xusb yet.
+        # IN data left by an aborted transfer is drained first, and the reply only counts with its ACK
+        # and a sane geometry, so stale data is never taken for the info.
+        try:
+            while len(self.dev.read(0x81, 0x10000, timeout=DRAIN_TIMEOUT)) > 0:
+                pass
+        except usb.core.USBError:
+            pass
+        try:
+            self.dev.ctrl_transfer(0x40, 0xB0, wValue=GET_INFO_CMD, wIndex=0, data_or_wLength='')
+            self.dev.ctrl_transfer(0x40, 0xA0, wValue=XFER_LEN_CMD, wIndex=84, data_or_wLength='')
+            self.dev.write(0x01, data, timeout=timeout)
+            info = self.dev.read(0x81, 84, timeout=timeout)
+            ack = self.dev.read(0x81, 4, timeout=timeout)
+        except usb.core.USBError:
+            self.info = b''
+            return False
+        if len(info) != 84 or len(ack) != 4 or int.from_bytes(ack, byteorder="little") != ACK or \
+                _sane_info(info) is False:
+            self.info = b''
+            return False
+        self.info = info
+        return True
+
     def set_id(self, i) -> None:
         self.id = i
 
@@ -80,105 +265,119 @@ class XUsbCom:
     def get_address(self) -> int:
         return self.address
 
-    @staticmethod
-    def set_align(nand, spinand, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block) -> None:
-        # See if we need to overwrite existing json file.
-        overwrite = False
-        try:
-            with open(".config", "r") as json_file:
-                cfg = json.load(json_file)
-            for key in cfg.keys():
-                if key == 'nand_align':
-                    if nand != int(cfg['nand_align']):
-                        overwrite = True
-                elif key == 'spinand_align':
-                    if spinand != int(cfg['spinand_align']):
-                        overwrite = True
-                elif key == 'nand_page':
-                    if npage != int(cfg['nand_page']):
-                        overwrite = True
-                elif key == 'nand_block':
-                    if nblock != int(cfg['nand_block']):
-                        overwrite = True
-                elif key == 'nand_block_cnt':
-                    if nbcnt != int(cfg['nand_block_cnt']):
-                        overwrite = True
-                elif key == 'nand_oob':
-                    if noob != int(cfg['nand_oob']):
-                        overwrite = True
-                elif key == 'spinand_page':
-                    if snpage != int(cfg['spinand_page']):
-                        overwrite = True
-                elif key == 'spinand_block':
-                    if snblock != int(cfg['spinand_block']):
-                        overwrite = True
-                elif key == 'spinand_block_cnt':
-                    if snbcnt != int(cfg['spinand_block_cnt']):
-                        overwrite = True
-                elif key == 'spinand_oob':
-                    if snoob != int(cfg['spinand_oob']):
-                        overwrite = True
-                elif key == 'emmc_block':
-                    if emmc_block != int(cfg['emmc_block']):
-                        overwrite = True
-        except (IOError, OSError, json.decoder.JSONDecodeError) as err:
-            overwrite = True
-
-        if overwrite is True:
+    def set_align(self, nand, spinand, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block) -> None:
+        # Each device keeps its own geometry, a station may mix flash parts. The flat keys of
+        # the legacy format are kept too, for older tools reading .config.
+        geometry = dict(zip(ALIGN_KEYS, (nand, spinand, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob,
+                                         emmc_block)))
+        with _config_lock:
+            cfg = _load_config()
+            devices = cfg.setdefault('devices', {})
+            if devices.get(self.geometry_key()) == geometry and all(cfg.get(key) == geometry[key] for key in ALIGN_KEYS):
+                return
+            devices[self.geometry_key()] = geometry
+            cfg.update(geometry)
+            _config_changed()
+
+    def get_align(self) -> typing.Tuple[int, int, int, int, int, int, int, int, int, int, int]:
+        # Geometry from the registry, no file access once .config has been read
+        with _config_lock:
+            cfg = _load_config()
+            geometry = cfg.get('devices', {}).get(self.geometry_key())
+            if geometry is None and any(key in cfg for key in ALIGN_KEYS):
+                geometry = cfg  # Written before geometry was kept per device
             try:
-                with open(".config", "w+") as json_file:
-                    new_key = {'nand_align': nand, 'spinand_align': spinand, \
-                        'nand_page': npage, 'nand_block': nblock, 'nand_block_cnt': nbcnt, 'nand_oob': noob,\
-                        'spinand_page': snpage, 'spinand_block': snblock, 'spinand_block_cnt': snbcnt,\
-                        'spinand_oob': snoob, 'emmc_block': emmc_block}
-                    json.dump(new_key, json_file, indent = 4)
-            except (IOError, OSError) as err:
-                print("Write .config failed. Please re-attach")
-                sys.exit(err)
+                return tuple(int(geometry.get(key, 0)) for key in ALIGN_KEYS)
+            except (AttributeError, TypeError, ValueError) as err:
+                print("Open/parsing .config failed. Please re-attach")
+                sys.exit(f"No geometry for device {self.geometry_key()}")
+
+    def geometry_key(self) -> str:
+        # Devices are told apart by port path, all share one entry if the backend can't tell
+        return self.port_key() or 'default'
+
+    def set_chunk_size(self, media, size) -> None:
+        # Tuned transfer chunk size is kept per device and media next to the geometry, boards on
+        # one station may differ in hub, cable and flash part
+        with _config_lock:
+            sizes = _load_config().setdefault('chunk_size', {})
+            if not isinstance(sizes.get(self.geometry_key()), dict):
+                sizes[self.geometry_key()] = {}     # Tuned per media only before
+            sizes[self.geometry_key()][str(media)] = size
+            _config_changed()
+
+    def get_chunk_size(self, media) -> int:
+        # 0 if no chunk size has been tuned for this device and media yet
+        with _config_lock:
+            try:
+                return int(_load_config()['chunk_size'][self.geometry_key()][str(media)])
+            except (KeyError, TypeError, ValueError) as err:
+                return 0
+
+    def port_key(self) -> str:
+        # Port path as bus-port.port.port like sysfs names it, '' if the backend can't tell
+        if self.port is None:
+            return ''
+        return f"{self.port[0]}-" + '.'.join(str(port) for port in self.port[1:])
 
     @staticmethod
-    def get_align() -> typing.Tuple[int, int, int, int, int, int, int, int, int, int, int]:
-        try:
-            with open(".config", "r") as json_file:
-                cfg = json.load(json_file)
-        except (IOError, OSError, json.decoder.JSONDecodeError) as err:
-            print("Open/parsing .config failed. Please re-attach")
-            sys.exit(err)
-        nand_align = spinand_align = npage = nblock = nbcnt = noob = snpage = snblock = snbcnt = snoob = emmc_block = 0
-        for key in cfg.keys():
-            if key == 'nand_align':
-                nand_align = int(cfg['nand_align'])
-            elif key == 'spinand_align':
-                spinand_align = int(cfg['spinand_align'])
-            elif key == 'nand_page':
-                npage = int(cfg['nand_page'])
-            elif key == 'nand_block':
-                nblock = int(cfg['nand_block'])
-            elif key == 'nand_block_cnt':
-                nbcnt = int(cfg['nand_block_cnt'])
-            elif key == 'nand_oob':
-                noob = int(cfg['nand_oob'])
-            elif key == 'spinand_page':
-                snpage = int(cfg['spinand_page'])
-            elif key == 'spinand_block':
-                snblock = int(cfg['spinand_block'])
-            elif key == 'spinand_block_cnt':
-                snbcnt = int(cfg['spinand_block_cnt'])
-            elif key == 'spinand_oob':
-                snoob = int(cfg['spinand_oob'])
-            elif key == 'emmc_block':
-                emmc_block = int(cfg['emmc_block'])
-        return nand_align, spinand_align, npage, nblock, nbcnt, noob, snpage, snblock, snbcnt, snoob, emmc_block
+    def port_slot(port, first) -> int:
+        # Slot a port got when first seen, kept in .config so it is the same every run. Slots below
+        # first are for the ports of a fixture map, a port without a slot takes the next one after.
+        with _config_lock:
+            slots = _load_config().setdefault('slots', {})
+            if not isinstance(slots.get(port), int) or slots[port] < first:
+                used = {slot for key, slot in slots.items() if key != port and isinstance(slot, int)}
+                slots[port] = min(slot for slot in range(first, first + len(used) + 1) if slot not in used)
+                _config_changed()
+            return slots[port]
+
+    @staticmethod
+    def add_stats(stats) -> dict:
+        # Add {port: [passed, failed, seconds]} of this run to the totals of every run kept in .config
+        with _config_lock:
+            totals = _load_config().setdefault('stats', {})
+            for port, counts in stats.items():
+                total = totals.get(port)
+                if not isinstance(total, list) or len(total) != 3:
+                    total = [0, 0, 0.0]
+                totals[port] = [total[0] + counts[0], total[1] + counts[1], round(total[2] + counts[2], 3)]
+            if len(stats) > 0:
+                _config_changed()
+            return {port: list(total) for port, total in totals.items()}
+
+    @staticmethod
+    def set_xusb(devices) -> None:
+        # Remember where devices run xusb. A device still at the same address has not re-enumerated
+        # since, so the next attach can skip the upload.
+        with _config_lock:
+            # Devices are attached one by one, keep the entries of the others
+            _load_config().setdefault('xusb', {}).update(
+                {dev.port_key(): dev.get_address() for dev in devices if dev.port_key() != ''})
+            _config_changed()
 
+    def is_xusb(self) -> bool:
+        # True if set_xusb() recorded this device at its current address
+        with _config_lock:
+            try:
+                return self.port_key() != '' and int(_load_config()['xusb'][self.port_key()]) == self.address
+            except (KeyError, TypeError, ValueError) as err:
+                return False
 
 class XUsbComList:
 
-    def __init__(self, attach_all=False):
-        vid = 0x0416
-        pid = 0x5963
+    # With previous, wait for those devices to come back running xusb instead of taking what is there now.
+    # data is sent with get_info to tell if a device is ready, the reply is left in its info.
+    # An empty previous gives an empty list for take() to collect devices in.
+    def __init__(self, attach_all=False, previous=None, data=None):
+        if previous is not None:
+            self.devices = self.__wait_ready(previous, data) if len(previous) > 0 else []
+            return
+        vid = VID
+        pid = PID
         try:
-            self.devices = list(usb.core.find(idVendor=vid, idProduct=pid,
-                                              find_all=True if attach_all is True else False))
+            self.devices = list(find_devices(idVendor=vid, idProduct=pid,
+                                             find_all=True if attach_all is True else False))
         except TypeError:
             # list will raise exception if there's no device
             self.devices = []
@@ -205,9 +404,65 @@ class XUsbComList:
             self.devices[i].set_bus(bus)
             self.devices[i].set_address(address)
 
+    @staticmethod
+    def __wait_ready(previous, data) -> list:
+        # A device is back once it shows up on the same port and answers get_info, which the boot
+        # ROM does not. Poll with a short backoff until all are back or the deadline passes.
+        ports = {dev.port for dev in previous}
+        # The boot ROM devices stay listed until they disconnect, skip them until they are gone
+        stale = {(dev.get_bus(), dev.get_address()) for dev in previous}
+        ready = {}
+        delay = ENUM_POLL
+        deadline = time.monotonic() + ENUM_TIMEOUT
+        begin = time.monotonic()
+        while len(ready) < len(previous):
+            try:
+                found = list(find_devices(idVendor=VID, idProduct=PID, find_all=True))
+            except usb.core.NoBackendError as err:
+                sys.exit(err)
+            stale &= {(dev.bus, dev.address) for dev in found}
+            for dev in found:
+                key = (dev.bus, dev.address)
+                if key in ready or key in stale or (port_path(dev) not in ports and None not in ports):
+                    continue
+                # Devices may be waited for one at a time from several threads, only one of them probes a device
+                with _ready_lock:
+                    if key in _ready_claimed:
+                        continue
+                    _ready_claimed.add(key)
+                try:
+                    dev.set_configuration()
+                except (usb.core.USBError, NotImplementedError):
+                    with _ready_lock:
+                        _ready_claimed.discard(key)
+                    continue    # Still enumerating
+                xusb = XUsbCom(dev)
+                xusb.set_bus(dev.bus)
+                xusb.set_address(dev.address)
+                if xusb.probe_info(data) is True:
+                    ready[key] = xusb
+                else:
+                    usb.util.dispose_resources(dev)
+                    with _ready_lock:
+                        _ready_claimed.discard(key)
+            if len(ready) == len(previous) or time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, ENUM_POLL_MAX)
+        if len(ready) < len(previous):
+            print(f"{len(previous) - len(ready)} device(s) not ready after {ENUM_TIMEOUT:.0f}s")
+        else:
+            print(f"{len(ready)} device(s) ready in {time.monotonic() - begin:.2f}s")
+        devices = list(ready.values())
+        for i in range(0, len(devices)):
+            devices[i].set_id(i)
+        return devices
+
     def __del__(self):
         if len(self.devices) != 0:
             for dev in self.devices:
+                with _ready_lock:
+                    _ready_claimed.discard((dev.get_bus(), dev.get_address()))
                 try:
                     usb.util.dispose_resources(dev.dev)
                     # dev.dev.reset()
@@ -218,5 +473,21 @@ class XUsbComList:
 
         self.devices = None
 
+    # Move the devices of another list to this one, they are released with this list
+    def take(self, other) -> None:
+        self.devices.extend(other.devices)
+        other.devices = []
+
+    # Let go of the devices on a port, for a station board that is done
+    def release(self, port) -> None:
+        for dev in [dev for dev in self.devices if dev.port_key() == port]:
+            self.devices.remove(dev)
+            with _ready_lock:
+                _ready_claimed.discard((dev.get_bus(), dev.get_address()))
+            try:
+                usb.util.dispose_resources(dev.dev)
+            except usb.core.USBError:
+                pass    # Unplugged already
+
     def get_dev(self):
         return self.devices